@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+
+"""
+Time each phase of grep-ast on synthetic corpora, and compare against a baseline.
+
+    python benchmarks/run.py --save      # record a baseline for this machine
+    python benchmarks/run.py             # compare against it, exit 1 on a slowdown
+
+The corpora are generated from a fixed seed, so runs are comparable.
+"""
+
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+# benchmark the checkout this script is in, not an installed copy
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from grep_ast import TreeContext  # noqa: E402
+from grep_ast.walk import enumerate_files  # noqa: E402
+
+DEFAULT_BASELINE = Path(__file__).resolve().parent / "baseline.json"
+
+# Phases faster than this are too noisy to flag
+MIN_SECONDS = 0.005
+
+WORDS = "alpha beta gamma delta value count total index item result buffer node".split()
+
+
+def gen_python(rnd, n_classes):
+    out = ["import os", "import sys", "", ""]
+    for c in range(n_classes):
+        out.append(f"class Widget{c}:")
+        out.append(f'    """Widget number {c}"""')
+        out.append("")
+        for m in range(rnd.randint(5, 15)):
+            word = rnd.choice(WORDS)
+            out.append(f"    def {word}_{m}(self, {word}, count=0):")
+            for depth in range(1, rnd.randint(2, 5)):
+                pad = "    " * (depth + 1)
+                out.append(f"{pad}if {word} > {depth}:")
+                out.append(f"{pad}    {word} = {word} * {depth} + count")
+            out.append(f"        return {word}")
+            out.append("")
+        out.append("")
+    return "\n".join(out) + "\n"
+
+
+def gen_js(rnd, n_classes):
+    out = ["'use strict';", ""]
+    for c in range(n_classes):
+        out.append(f"class Widget{c} {{")
+        for m in range(rnd.randint(5, 15)):
+            word = rnd.choice(WORDS)
+            out.append(f"  {word}{m}({word}, count) {{")
+            for depth in range(1, rnd.randint(2, 5)):
+                pad = "  " * (depth + 1)
+                out.append(f"{pad}if ({word} > {depth}) {{")
+                out.append(f"{pad}  {word} = {word} * {depth} + count;")
+            for depth in reversed(range(1, depth + 1)):
+                out.append("  " * (depth + 1) + "}")
+            out.append(f"    return {word};")
+            out.append("  }")
+        out.append("}")
+        out.append("")
+    return "\n".join(out) + "\n"
+
+
+def gen_go(rnd, n_funcs):
+    out = ["package widgets", "", 'import "fmt"', ""]
+    for f in range(n_funcs):
+        word = rnd.choice(WORDS)
+        out.append(f"func {word.title()}{f}({word} int, count int) int {{")
+        out.append("\tfor i := 0; i < count; i++ {")
+        out.append(f"\t\tif {word} > i {{")
+        out.append(f"\t\t\t{word} += i")
+        out.append("\t\t} else {")
+        out.append(f'\t\t\tfmt.Println("{word}", i)')
+        out.append("\t\t}")
+        out.append("\t}")
+        out.append(f"\treturn {word}")
+        out.append("}")
+        out.append("")
+    return "\n".join(out) + "\n"
+
+
+def gen_c(rnd, n_funcs):
+    out = ["#include <stdio.h>", ""]
+    for f in range(n_funcs):
+        word = rnd.choice(WORDS)
+        out.append(f"int {word}_{f}(int {word}, int count)")
+        out.append("{")
+        out.append("    for (int i = 0; i < count; i++) {")
+        out.append(f"        switch ({word} % 3) {{")
+        out.append("        case 0:")
+        out.append(f"            {word} += i;")
+        out.append("            break;")
+        out.append("        default:")
+        out.append(f'            printf("{word} %d\\n", i);')
+        out.append("        }")
+        out.append("    }")
+        out.append(f"    return {word};")
+        out.append("}")
+        out.append("")
+    return "\n".join(out) + "\n"
+
+
+def gen_json(rnd, depth):
+    out = []
+    for d in range(depth):
+        out.append("  " * d + "{")
+        out.append("  " * (d + 1) + f'"{rnd.choice(WORDS)}{d}": {d},')
+        out.append("  " * (d + 1) + '"child":')
+    out.append("  " * depth + "null")
+    for d in reversed(range(depth)):
+        out.append("  " * d + "}")
+    return "\n".join(out) + "\n"
+
+
+def gen_tree(rnd, root, n_files):
+    """A source tree with nested directories, an ignore file and ignored bulk"""
+    os.makedirs(root, exist_ok=True)
+    Path(root, ".gitignore").write_text("build/\n*.gen.py\n")
+    for i in range(n_files):
+        parts = [f"pkg{rnd.randrange(8)}", f"sub{rnd.randrange(8)}"]
+        path = Path(root, *parts, f"mod{i}.py")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(gen_python(rnd, 1))
+    for i in range(n_files // 4):
+        path = Path(root, "build", f"dir{i % 16}", f"out{i}.py")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text("x = 1\n")
+
+
+def make_corpus(dirname, scale):
+    """Write the corpus files into dirname, return [(case name, filename, pattern)]"""
+    rnd = random.Random(1234)
+    files = [
+        ("python", "big.py", gen_python(rnd, 200 * scale), r"count\b"),
+        ("javascript", "big.js", gen_js(rnd, 200 * scale), "return"),
+        ("go", "big.go", gen_go(rnd, 1000 * scale), "Println"),
+        ("c", "big.c", gen_c(rnd, 800 * scale), "printf"),
+        ("json", "deep.json", gen_json(rnd, 300 * scale), "child"),
+    ]
+
+    cases = []
+    for name, fname, code, pattern in files:
+        fname = os.path.join(dirname, fname)
+        Path(fname).write_text(code)
+        cases.append((name, fname, pattern))
+
+    gen_tree(rnd, os.path.join(dirname, "tree"), 1000 * scale)
+    return cases
+
+
+def file_phases(fname, pattern):
+    """The (name, function) phases of searching one file, in the order they run"""
+    state = dict()
+
+    def init():
+        with open(fname, encoding="utf8") as f:
+            code = f.read()
+        state["tc"] = TreeContext(fname, code, color=True)
+        state["tc"].parse()
+
+    def grep():
+        state["lois"] = state["tc"].grep(pattern, False)
+
+    def add_context():
+        tc = state["tc"]
+        tc.add_lines_of_interest(state["lois"])
+        tc.add_context()
+
+    def format_output():
+        state["output"] = state["tc"].format()
+
+    return [("init", init), ("grep", grep), ("add_context", add_context), ("format", format_output)]
+
+
+def measure(make_phases, repeat):
+    """The best time and the peak traced memory of each phase"""
+    results = dict()
+    for run in range(repeat + 1):
+        # the last run is traced, as tracing slows everything down
+        trace = run == repeat
+        for phase, func in make_phases():
+            gc.collect()
+            if trace:
+                tracemalloc.start()
+                func()
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                results[phase]["peak_kb"] = round(peak / 1024)
+                continue
+
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+            best = results.setdefault(phase, dict(seconds=elapsed))
+            best["seconds"] = min(best["seconds"], elapsed)
+
+    return results
+
+
+def run_benchmarks(dirname, scale, repeat):
+    results = dict()
+    for name, fname, pattern in make_corpus(dirname, scale):
+        for phase, result in measure(lambda: file_phases(fname, pattern), repeat).items():
+            results[f"{name}/{phase}"] = result
+
+    tree = os.path.join(dirname, "tree")
+
+    def walk_phases():
+        return [("enumerate_files", lambda: sum(1 for _ in enumerate_files([tree])))]
+
+    for phase, result in measure(walk_phases, repeat).items():
+        results[f"tree/{phase}"] = result
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Print each result next to its baseline, return the names that got slower"""
+    slower = []
+    print(f"{'benchmark':<28} {'seconds':>10} {'baseline':>10} {'change':>8} {'peak KB':>9}")
+    for name, result in results.items():
+        seconds = result["seconds"]
+        line = f"{name:<28} {seconds:10.4f}"
+
+        base = baseline.get(name)
+        if base:
+            change = seconds / base["seconds"] - 1
+            line += f" {base['seconds']:10.4f} {change:+8.1%}"
+            if change > threshold and seconds - base["seconds"] > MIN_SECONDS:
+                slower.append(name)
+                line += f" {result['peak_kb']:9}  SLOWER"
+            else:
+                line += f" {result['peak_kb']:9}"
+        else:
+            line += f" {'':>10} {'':>8} {result['peak_kb']:9}"
+        print(line)
+
+    return slower
+
+
+def positive_int(text):
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, not {value}")
+    return value
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--baseline",
+        default=str(DEFAULT_BASELINE),
+        help="the baseline results file (default: %(default)s)",
+    )
+    parser.add_argument("--save", action="store_true", help="save the results as the baseline")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.25,
+        help="flag phases this much slower than the baseline (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--repeat", type=positive_int, default=5, help="timed runs per phase (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--scale", type=int, default=1, help="multiply the corpus sizes (default: %(default)s)"
+    )
+    parser.add_argument("--corpus-dir", help="write the corpus here instead of a temp dir")
+    args = parser.parse_args()
+
+    if args.corpus_dir:
+        os.makedirs(args.corpus_dir, exist_ok=True)
+        results = run_benchmarks(args.corpus_dir, args.scale, args.repeat)
+    else:
+        with tempfile.TemporaryDirectory() as dirname:
+            results = run_benchmarks(dirname, args.scale, args.repeat)
+
+    baseline = dict()
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("scale") != args.scale:
+            print(f"Baseline was recorded with --scale {baseline.get('scale')}, not comparing")
+            baseline = dict()
+
+    slower = compare(results, baseline.get("results", dict()), args.threshold)
+
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump(dict(scale=args.scale, results=results), f, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+        return
+
+    if slower:
+        print(f"\n{len(slower)} benchmark(s) more than {args.threshold:.0%} slower than baseline")
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
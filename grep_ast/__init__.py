@@ -1,4 +1,8 @@
 # noqa: F401
 
-from .grep_ast import TreeContext
+from .cache import ScopeCache
+from .grep_ast import ParseLimitError, TreeContext
 from .parsers import filename_to_lang
+from .result import Result
+from .search import search_file, search_files, search_files_async
+from .stats import Stats
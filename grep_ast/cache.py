@@ -0,0 +1,129 @@
+import hashlib
+import marshal
+import os
+
+from .dump import dump  # noqa: F401
+from .tsl import grammar_version
+
+# Bump whenever the layout of the cached tables changes
+CACHE_VERSION = 3
+
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+# Once the cache outgrows max_size, evict entries until it is this fraction of it
+EVICT_TO = 0.8
+
+
+class ScopeCache:
+    """
+    An on-disk cache of the per-line tables that TreeContext builds from the
+    parse tree, so unchanged files don't have to be parsed again.
+
+    Each file has one entry, named after its path, language and grammar version.
+    An entry is only used if the file's size, mtime and content hash still match.
+    Entries are written with an atomic rename, so concurrent runs can share a
+    cache directory. The least recently used entries are evicted once the
+    cache grows past max_size bytes.
+    """
+
+    def __init__(self, cache_dir, max_size=DEFAULT_MAX_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+        # bytes on disk, counted on the first put()
+        self.size = None
+
+    def get(self, filename, lang, code, header_max):
+        path = self.entry_path(filename, lang, header_max)
+        try:
+            with open(path, "rb") as f:
+                version, fingerprint, tables = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            return
+
+        if version != CACHE_VERSION or fingerprint != self.fingerprint(filename, code):
+            return
+
+        # mark it as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return tables
+
+    def put(self, filename, lang, code, header_max, tables):
+        # imported here, as it's slow to import and only needed once there's a cache miss
+        import tempfile
+
+        path = self.entry_path(filename, lang, header_max)
+        data = marshal.dumps((CACHE_VERSION, self.fingerprint(filename, code), list(tables)))
+
+        dirname = os.path.dirname(path)
+        tmp = None
+        try:
+            os.makedirs(dirname, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            if tmp:
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+            return
+
+        if self.size is None:
+            self.size = sum(size for _, size, _ in self.entries())
+        else:
+            self.size += len(data)
+
+        if self.size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        target = self.max_size * EVICT_TO
+
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # probably evicted by another process already
+                pass
+            total -= size
+
+        self.size = total
+
+    def entries(self):
+        """(mtime, size, path) of every file in the cache"""
+        for dirpath, _, fnames in os.walk(self.cache_dir):
+            for fname in fnames:
+                path = os.path.join(dirpath, fname)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield st.st_mtime_ns, st.st_size, path
+
+    def entry_path(self, filename, lang, header_max):
+        key = repr(
+            (os.path.abspath(filename), lang, header_max, grammar_version(), marshal.version)
+        )
+        digest = hashlib.sha256(key.encode("utf8")).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest[2:])
+
+    def fingerprint(self, filename, code):
+        try:
+            st = os.stat(filename)
+            size, mtime = st.st_size, st.st_mtime_ns
+        except OSError:
+            # not a file on disk, just a buffer
+            size, mtime = None, None
+
+        return size, mtime, hashlib.blake2b(code, digest_size=16).hexdigest()
@@ -1,13 +1,92 @@
 #!/usr/bin/env python
 
+import copy
+import heapq
+import io
 import re
+from array import array
+from bisect import bisect_right
+from functools import lru_cache, wraps
+from itertools import accumulate
 
 from .dump import dump  # noqa: F401
 from .parsers import filename_to_lang
-from .tsl import get_parser
+from .result import Result, line_ranges
+from .stats import phase_timer
+from .tsl import get_parser, get_query, parse_with_timeout, query_nodes
+from .utf8 import Utf8Lines, compile_bytes, has_odd_line_breaks
+
+# Anchors and lookarounds that see past the end of a line when searching a
+# whole file, so patterns using them are searched line by line
+LINE_BOUND = re.compile(r"\\[ABZ]|\(\?<?[=!]")
+
+# The parts of a regex that pattern_source() rewrites when it combines
+# several, and the single characters or escapes between them
+REGEX_TOKEN = re.compile(
+    r"\\(?:0[0-7]{0,2}|[1-7][0-7]{2})"  # octal escapes
+    r"|\\(?P<backref>[1-9][0-9]?)"
+    r"|\\."
+    r"|\[\^?\]?(?:\\.|[^\]\\])*\]"  # sets, where a backslash and digits are octal
+    r"|\(\?P<(?P<group>\w+)>"
+    r"|\(\?P=(?P<name_ref>\w+)\)"
+    r"|\(\?\((?P<cond>\w+)\)"
+    r"|\(\?(?P<flags>[aiLmsux]+)\)"
+    r"|.",
+    re.DOTALL,
+)
+
+# scope_parents entry for a line whose parent hasn't been looked up yet
+UNKNOWN = -2
+
+# The __init__ options that only affect how lines are picked and shown, so
+# render() can override them without rebuilding the tables
+RENDER_OPTIONS = (
+    "color",
+    "line_number",
+    "parent_context",
+    "child_context",
+    "last_line",
+    "margin",
+    "mark_lois",
+    "show_top_of_file_parent_scope",
+    "loi_pad",
+)
+
+
+def timed(phase, parse=True):
+    """
+    Decorate a TreeContext method to time each call as phase, if there are
+    stats. With parse=True the lazy parse happens first, so it isn't timed
+    as part of phase.
+    """
+
+    def decorate(method):
+        @wraps(method)
+        def timed_method(self, *args, **kwargs):
+            if self.stats is None:
+                return method(self, *args, **kwargs)
+
+            if parse:
+                self.parse()
+            with self.timer(phase):
+                return method(self, *args, **kwargs)
+
+        return timed_method
+
+    return decorate
+
+
+class ParseLimitError(Exception):
+    """
+    A file is too big to parse under its TreeContext's limits, or took longer
+    than parse_timeout
+    """
 
 
 class TreeContext:
+    # The per-line tables built by parse(), or loaded from a ScopeCache
+    TABLES = ("scope_sizes", "child_spans", "header_mins")
+
     def __init__(
         self,
         filename,
@@ -23,6 +102,12 @@ class TreeContext:
         header_max=10,
         show_top_of_file_parent_scope=True,
         loi_pad=1,
+        cache=None,
+        incremental=False,
+        stats=None,
+        parse_timeout=None,
+        max_lines=None,
+        max_line_length=None,
     ):
         self.filename = filename
         self.color = color
@@ -37,74 +122,729 @@ class TreeContext:
 
         self.parent_context = parent_context
         self.child_context = child_context
+        self.cache = cache
+        self.incremental = incremental
+
+        # a Stats to record the time spent in each phase in, if any
+        self.stats = stats
+
+        # Limits on the files worth parsing, and the seconds to give up on a
+        # parse after. parse() raises ParseLimitError for files over them.
+        self.parse_timeout = parse_timeout
+        self.max_lines = max_lines
+        self.max_line_length = max_line_length
 
         lang = filename_to_lang(filename)
         if not lang:
             raise ValueError(f"Unknown language for {filename}")
+        self.lang = lang
 
-        # Get parser based on file extension
-        parser = get_parser(lang)
-        tree = parser.parse(bytes(code, "utf8"))
-
-        self.lines = code.splitlines()
-        self.num_lines = len(self.lines) + 1
+        self.set_code(code)
 
         # color lines, with highlighted matches
         self.output_lines = dict()
 
-        # Which scopes is each line part of?
-        # A scope is the line number on which the scope started
-        self.scopes = [set() for _ in range(self.num_lines)]
+        # the patterns that hit each line, when grepping for more than one
+        self.line_patterns = dict()
+
+        # The (start, end) columns of the matches grep() found on each line.
+        # Unless grep_regex is None, only the first match of each line is in
+        # there, and grep_regex finds the rest.
+        self.grep_spans = dict()
+        self.grep_regex = None
+
+        self.show_lines = set()
+        self.lines_of_interest = set()
+
+        # set on the copies render() works on, to look up add_parent_scopes() results
+        self.parent_scope_memo = None
+
+        # The parse and the scope/header tables are built lazily, on first use.
+        # Callers that only grep and find nothing never pay for tree-sitter.
+        self.parsed = False
+
+        # With incremental=True the tree is kept, so update() can reparse just the edit
+        self.tree = None
+
+    def __getattr__(self, name):
+        if name in self.TABLES and not self.__dict__.get("parsed", True):
+            self.parse()
+            return self.__dict__[name]
+        if name == "code" and self.__dict__.get("data") is not None:
+            self.code = self.data.decode("utf8", "replace")
+            return self.code
+        raise AttributeError(f"{type(self).__name__!r} object has no attribute {name!r}")
+
+    def set_code(self, code):
+        """Set the code and its lines, from str or UTF-8 bytes"""
+        # a str decoded from the old bytes, if anything asked for one
+        self.__dict__.pop("code", None)
+
+        if isinstance(code, bytes):
+            # UTF-8 bytes go straight to tree-sitter, and lines are only decoded
+            # as they're used. self.code is decoded if anything asks for it.
+            self.data = code
+            if has_odd_line_breaks(code):
+                self.lines = code.decode("utf8", "replace").splitlines()
+            else:
+                self.lines = Utf8Lines(code)
+        else:
+            self.data = None
+            self.code = code
+            self.lines = code.splitlines()
+
+        self.num_lines = len(self.lines) + 1
+
+    def parse(self, keep_tree=False):
+        if self.parsed:
+            return
+        self.check_limits()
+        self.parsed = True
+
+        code = self.code_bytes()
+        if self.cache:
+            with self.timer("cache"):
+                tables = self.cache.get(self.filename, self.lang, code, self.header_max)
+            if tables:
+                for name, table in zip(self.TABLES, tables):
+                    setattr(self, name, array("i", table))
+                self.reset_scope_parents()
+                return
+
+        try:
+            tree = self.parse_tree(code)
+        except ParseLimitError:
+            self.parsed = False
+            raise
+        if self.incremental or keep_tree:
+            self.tree = tree
+
+        with self.timer("walk"):
+            walked = self.build_tables(tree)
+
+        if self.stats is not None:
+            self.stats.count("parsed")
+            self.stats.count("nodes", walked)
+
+        if self.cache:
+            tables = [getattr(self, name).tobytes() for name in self.TABLES]
+            with self.timer("cache"):
+                self.cache.put(self.filename, self.lang, code, self.header_max, tables)
+
+    def parse_tree(self, code):
+        # Get parser based on file extension
+        parser = get_parser(self.lang)
+        with self.timer("parse"):
+            tree = parse_with_timeout(parser, code, self.parse_timeout)
+        if tree is None:
+            raise ParseLimitError(f"Parsing {self.filename} took over {self.parse_timeout}s")
+        return tree
+
+    def syntax_tree(self):
+        """
+        The tree-sitter tree of the code, for queries. It's kept from parse(),
+        or parsed again if the tables came from the cache.
+        """
+        if not self.parsed:
+            self.parse(keep_tree=True)
+        if self.tree is None:
+            self.check_limits()
+            self.tree = self.parse_tree(self.code_bytes())
+        return self.tree
+
+    def check_limits(self):
+        """Raise ParseLimitError if the file has too many lines, or too long a line"""
+        if self.max_lines and len(self.lines) > self.max_lines:
+            raise ParseLimitError(f"{self.filename} has over {self.max_lines} lines")
 
-        # Which lines serve as a short "header" for the scope starting on that line
-        self.header = [list() for _ in range(self.num_lines)]
+        if self.max_line_length:
+            # UTF-8 lines are measured in bytes, which saves decoding them
+            lines = self.lines.raw if isinstance(self.lines, Utf8Lines) else self.lines
+            if max(map(len, lines), default=0) > self.max_line_length:
+                raise ParseLimitError(
+                    f"{self.filename} has lines over {self.max_line_length} characters"
+                )
 
-        self.nodes = [list() for _ in range(self.num_lines)]
+    def code_bytes(self):
+        """The code as UTF-8 bytes, for tree-sitter"""
+        if self.data is not None:
+            return self.data
+        return bytes(self.code, "utf8")
+
+    def timer(self, phase):
+        """A context manager timing its body as phase in self.stats, if there are stats"""
+        return phase_timer(self.stats, phase, self.lang)
+
+    def build_tables(self, tree):
+        # How many lines past each line the biggest node starting on it ends,
+        # -1 if no node starts there. A scope is the line number on which the
+        # scope started, and enclosing_scopes() finds a line's scopes from these.
+        self.scope_sizes = array("i", [-1]) * self.num_lines
+
+        # How many lines past each line the last node inside its scope starts
+        self.child_spans = array("i", [-1]) * self.num_lines
+
+        # What header_size() needs to know about the multi-line nodes starting on
+        # each line: 0 for none, -size for just one, or the smallest size of several
+        self.header_mins = array("i", [0]) * self.num_lines
+
+        # filled in by walk_tree() too, so looking up the scopes of a line is cheap
+        self.reset_scope_parents()
 
         root_node = tree.root_node
-        self.walk_tree(root_node)
+        walked = self.walk_tree(root_node)
 
         if self.verbose:
-            scope_width = max(len(str(set(self.scopes[i]))) for i in range(self.num_lines - 1))
-        for i in range(self.num_lines):
-            header = sorted(self.header[i])
-            if self.verbose and i < self.num_lines - 1:
-                scopes = str(sorted(set(self.scopes[i])))
-                print(f"{scopes.ljust(scope_width)}", i, self.lines[i])
-
-            if len(header) > 1:
-                size, head_start, head_end = header[0]
-                if size > self.header_max:
-                    head_end = head_start + self.header_max
+            scopes = [sorted(self.enclosing_scopes(i)) for i in range(self.num_lines - 1)]
+            scope_width = max(len(str(set(line_scopes))) for line_scopes in scopes)
+            for i, line_scopes in enumerate(scopes):
+                print(f"{str(line_scopes).ljust(scope_width)}", i, self.lines[i])
+
+        return walked
+
+    def header_size(self, line):
+        """
+        How many lines of the scope starting on line serve as its short "header".
+        Only the few scopes that are shown ever need this, so it's worked out
+        from header_mins as they're shown, rather than for every line up front.
+        """
+        smallest = self.header_mins[line]
+        if smallest > 0:
+            return min(smallest, self.header_max)
+        return 1
+
+    def reset_scope_parents(self, first=0):
+        # The closest enclosing scope start of each line, filled in as needed by
+        # scope_parent(). The lines before first keep the parents already found.
+        unknown = array("i", [UNKNOWN]) * (len(self.scope_sizes) - first)
+        if first:
+            self.scope_parents[first:] = unknown
+        else:
+            self.scope_parents = unknown
+
+        # The lines add_parent_scopes() shows for each line, per combination of
+        # the options they depend on. Any change to the tables can change them all.
+        self.parent_scope_memos = dict()
+
+    def scope_parent(self, line):
+        """
+        The last line before line on which a scope that reaches line starts, or -1.
+        Lines in between only have scopes that end before line, so the search
+        can jump straight to their own parents.
+        """
+        parents = self.scope_parents
+        if parents[line] != UNKNOWN:
+            return parents[line]
+
+        sizes = self.scope_sizes
+        pending = [line]
+        while pending:
+            line = pending[-1]
+            parent = line - 1
+            while parent >= 0 and parent + sizes[parent] < line:
+                if parents[parent] == UNKNOWN:
+                    pending.append(parent)
+                    break
+                parent = parents[parent]
             else:
-                head_start = i
-                head_end = i + 1
+                parents[line] = parent
+                pending.pop()
+
+        return parent
+
+    def enclosing_scopes(self, i):
+        """Yield the start of every scope that line i is part of, innermost first"""
+        if self.scope_sizes[i] >= 0:
+            start = i
+        else:
+            start = self.scope_parent(i)
+
+        while start >= 0:
+            if start + self.scope_sizes[start] >= i:
+                yield start
+            start = self.scope_parent(start)
 
-            self.header[i] = head_start, head_end
+    def update(self, new_code):
+        """
+        Replace the code with new_code, which is usually a small edit of it.
+        Like the code given to __init__, it can be str or UTF-8 bytes.
+        With incremental=True only the edited region is reparsed and only
+        the affected lines of the tables are rebuilt.
+        """
+        old = self.code_bytes()
+        new = new_code if isinstance(new_code, bytes) else bytes(new_code, "utf8")
 
+        start = common_prefix_len(old, new)
+        end = common_suffix_len(old, new, min(len(old), len(new)) - start)
+        self.apply_edit(start, len(old) - end, len(new) - end, new_code)
+
+    def apply_edit(self, start_byte, old_end_byte, new_end_byte, new_code):
+        """
+        Like update(), for callers that already know what changed: the utf8 bytes
+        old[start_byte:old_end_byte] were replaced with new[start_byte:new_end_byte].
+        Lines of interest, show lines and grep highlights are reset.
+        """
+        old = self.code_bytes()
+        self.set_code(new_code)
+        new = self.code_bytes()
+
+        self.output_lines = dict()
+        self.line_patterns = dict()
+        self.grep_spans = dict()
         self.show_lines = set()
         self.lines_of_interest = set()
 
-        return
+        if not self.parsed:
+            return
+
+        if not self.tree:
+            # nothing to reparse from, so rebuild everything on next use
+            self.parsed = False
+            for name in self.TABLES:
+                self.__dict__.pop(name, None)
+            return
+
+        start_point = byte_to_point(old, start_byte)
+        old_end_point = byte_to_point(old, old_end_byte)
+        new_end_point = byte_to_point(new, new_end_byte)
+
+        old_tree = self.tree
+        old_tree.edit(
+            start_byte, old_end_byte, new_end_byte, start_point, old_end_point, new_end_point
+        )
+        self.tree = get_parser(self.lang).parse(new, old_tree)
+
+        if old_tree.root_node.has_error or self.tree.root_node.has_error:
+            # error recovery can move nodes far away from the edit
+            self.build_tables(self.tree)
+            return
+
+        # rebuild lines lo..hi, which covers the edit and anything that now parses differently
+        lo = start_point[0]
+        hi = new_end_point[0]
+        for changed in old_tree.changed_ranges(self.tree):
+            lo = min(lo, changed.start_point[0])
+            hi = max(hi, changed.end_point[0])
+
+        self.patch_tables(lo, hi, new_end_point[0] - old_end_point[0])
+
+    def patch_tables(self, lo, hi, delta):
+        """
+        Rebuild lines lo..hi of the tables from the new tree. They replace old
+        lines lo..hi-delta, and the old lines after those move down by delta.
+        The tables are relative to the line they describe, so the moved lines
+        keep their values.
+        """
+        old_hi = hi - delta
+
+        # The scopes that overlapped lo..hi before or after the edit start before
+        # lo, but may not end where they used to
+        outer = set(start for start in self.enclosing_scopes(lo) if start < lo)
+
+        # Parents are only looked up again from where the first scope moved
+        first_moved = lo
+
+        *rows, new_outer = self.walk_rows(lo, hi)
+        for line in outer | new_outer:
+            old_size = self.scope_sizes[line]
+            for table, row in zip(self.TABLES, self.walk_rows(line, line)):
+                getattr(self, table)[line] = row[0]
+            new_size = self.scope_sizes[line]
+            if new_size != old_size:
+                first_moved = min(first_moved, line + min(old_size, new_size) + 1)
+
+        for name, row in zip(self.TABLES, rows):
+            table = getattr(self, name)
+            table[lo : old_hi + 1] = row
+
+            # str.splitlines() and tree-sitter don't always agree on the number of lines
+            del table[self.num_lines :]
+            if len(table) < self.num_lines:
+                table.extend(array("i", [self.empty_row(name)]) * (self.num_lines - len(table)))
+
+        self.reset_scope_parents(first_moved)
+
+    def empty_row(self, name):
+        if name == "header_mins":
+            return 0
+        return -1
+
+    def walk_rows(self, lo, hi):
+        """
+        Build lines lo..hi of the tables from self.tree, only visiting nodes
+        that overlap those lines. Also returns the lines before lo where nodes
+        that overlap lo..hi start.
+        """
+        size = hi - lo + 1
+        scope_sizes = array("i", [-1]) * size
+        child_spans = array("i", [-1]) * size
+        header_mins = array("i", [0]) * size
+        outer = set()
+
+        # [children left to visit, inside lo..hi, start line, end line, node, last start]
+        # for the node being visited and its ancestors
+        stack = []
+
+        def enter(node):
+            start_line = node.start_point[0]
+            end_line = node.end_point[0]
+
+            if start_line < lo:
+                outer.add(start_line)
+            else:
+                i = start_line - lo
+                scope_sizes[i] = max(scope_sizes[i], end_line - start_line)
+                if end_line > start_line:
+                    add_header_node(header_mins, i, end_line - start_line)
+
+            inside = lo <= start_line and end_line <= hi
+            if end_line == start_line:
+                # nothing on one line adds to the tables, as in walk_tree()
+                children = iter(())
+            elif inside:
+                children = iter(node.children)
+            else:
+                # only visit the children that overlap lo..hi
+                first = first_child_ending_after(node, lo - 1)
+                children = (node.child(i) for i in range(first, node.child_count))
+
+            stack.append([children, inside, start_line, end_line, node, start_line])
+
+        enter(self.tree.root_node)
+        while stack:
+            children, inside, start_line, end_line, node, last_start = stack[-1]
+            child = next(children, None)
+            if child is not None and child.start_point[0] <= hi:
+                enter(child)
+                continue
+
+            stack.pop()
+            if lo <= start_line:
+                if end_line > hi:
+                    # not all the children were visited
+                    last_start = last_node_start(node)
+                i = start_line - lo
+                child_spans[i] = max(child_spans[i], last_start - start_line)
+
+            parent = stack[-1] if stack else None
+            if parent and parent[1]:
+                parent[5] = last_start
+
+        return scope_sizes, child_spans, header_mins, outer
+
+    def grep(
+        self,
+        pat,
+        ignore_case,
+        multiline=False,
+        max_count=None,
+        fixed=False,
+        inside=None,
+        outside=None,
+    ):
+        """
+        Find the lines that match pat, highlighting the matches if color is on.
+        Normally a match must fit on one line, just like searching line by line.
+        With multiline=True a match can span lines, and marks all of them.
+        With max_count, the search stops after that many lines.
+
+        pat can also be a list of patterns, which are all searched for in one
+        pass, and the ones that hit each line are shown next to it.
+        With fixed=True the patterns are literal strings rather than regexes.
+
+        inside and outside are tree-sitter queries, or tuples of node types, to
+        only keep the matches that start inside a node that inside captures, and
+        not inside one that outside captures. These need the file parsed.
+        """
+        if inside is not None or outside is not None:
+            # parsed first, so the parse isn't timed as part of the grep
+            self.syntax_tree()
+        return self.grep_lines(pat, ignore_case, multiline, max_count, fixed, inside, outside)
+
+    @timed("grep", parse=False)
+    def grep_lines(self, pat, ignore_case, multiline, max_count, fixed, inside, outside):
+        filtered = inside is not None or outside is not None
+        if filtered:
+            # which matches count isn't known until they're filtered
+            limit, max_count = max_count, None
+
+        patterns = (pat,) if isinstance(pat, str) else tuple(pat)
+        pat = pattern_source(patterns, fixed)
+
+        flags = re.MULTILINE
+        if ignore_case:
+            flags |= re.IGNORECASE
+        regex = re.compile(pat, flags)
 
-    def grep(self, pat, ignore_case):
+        bytes_regex = None
+        if isinstance(self.lines, Utf8Lines) and not multiline:
+            bytes_regex = compile_bytes(pat, flags, self.data)
+
+        if bytes_regex and not LINE_BOUND.search(pat):
+            spans = self.grep_bytes(bytes_regex, regex, max_count)
+        elif multiline or not LINE_BOUND.search(pat):
+            spans = self.grep_buffer(regex, multiline, max_count)
+        else:
+            spans = dict()
+            for i, line in enumerate(self.lines):
+                line_spans = [match.span() for match in regex.finditer(line)]
+                if line_spans:
+                    spans[i] = line_spans
+                    if len(spans) == max_count:
+                        break
+
+        if filtered:
+            spans = self.filter_spans(spans, regex, multiline, inside, outside)
+            max_count = limit
+
+        if max_count and len(spans) > max_count:
+            # a multiline match can go past max_count
+            spans = {i: spans[i] for i in sorted(spans)[:max_count]}
+
+        if self.color:
+            for i, line_spans in spans.items():
+                self.output_lines[i] = highlight(self.lines[i], line_spans)
+
+        self.line_patterns = dict()
+        if len(patterns) > 1:
+            self.line_patterns = self.which_patterns(patterns, flags, fixed, spans)
+
+        self.grep_spans = spans
+        self.grep_regex = None if self.color or multiline or filtered else regex
+
+        # Add them one at a time in line order, like a line by line search. The
+        # order of the set decides which child scopes add_context() shows first.
         found = set()
-        for i, line in enumerate(self.lines):
-            if re.search(pat, line, re.IGNORECASE if ignore_case else 0):
-                if self.color:
-                    highlighted_line = re.sub(
-                        pat,
-                        lambda match: f"\033[1;31m{match.group()}\033[0m",  # noqa
-                        line,
-                        flags=re.IGNORECASE if ignore_case else 0,
-                    )
-                    self.output_lines[i] = highlighted_line
-                found.add(i)
+        for i in sorted(spans):
+            found.add(i)
         return found
 
+    def filter_spans(self, spans, regex, multiline, inside, outside):
+        """
+        Keep the matches in spans that start inside a node captured by the
+        query inside and not in one captured by outside. Returns the spans of
+        every match kept, not just the first on each line.
+        """
+        inside_ranges = outside_ranges = None
+        if inside is not None:
+            inside_ranges = self.query_ranges(inside)
+        if outside is not None:
+            outside_ranges = self.query_ranges(outside)
+
+        kept = dict()
+        for i, line_spans in spans.items():
+            line = self.lines[i]
+            if not (self.color or multiline):
+                line_spans = [match.span() for match in regex.finditer(line)]
+
+            line_kept = []
+            for start, end in line_spans:
+                # tree-sitter columns are in bytes
+                column = start if line.isascii() else len(line[:start].encode("utf8"))
+                point = (i, column)
+                if inside_ranges is not None and not in_ranges(inside_ranges, point):
+                    continue
+                if outside_ranges is not None and in_ranges(outside_ranges, point):
+                    continue
+                line_kept.append((start, end))
+
+            if line_kept:
+                kept[i] = line_kept
+        return kept
+
+    def query_ranges(self, source):
+        """
+        The parts of the code covered by the nodes that the query source
+        captures, as sorted lists of the (row, column) points each part starts
+        and ends on
+        """
+        starts = []
+        ends = []
+
+        query = get_query(self.lang, source)
+        if query is None:
+            return starts, ends
+
+        nodes = query_nodes(query, self.syntax_tree().root_node)
+        for start, end in sorted(
+            (tuple(node.start_point), tuple(node.end_point)) for node in nodes
+        ):
+            if ends and start <= ends[-1]:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        return starts, ends
+
+    def query(self, source, max_count=None, outside=None):
+        """
+        Find the lines that the nodes captured by the tree-sitter query source
+        start on, or the nodes of the types in source if it's a tuple, for use
+        as lines of interest. With max_count, only the first that many lines.
+        outside is a query like source, to leave out the nodes that start
+        inside a node it captures.
+        """
+        tree = self.syntax_tree()
+        with self.timer("grep"):
+            self.line_patterns = dict()
+            self.grep_spans = dict()
+
+            query = get_query(self.lang, source)
+            if query is None:
+                return set()
+
+            points = [tuple(node.start_point) for node in query_nodes(query, tree.root_node)]
+            if outside is not None:
+                outside_ranges = self.query_ranges(outside)
+                points = [point for point in points if not in_ranges(outside_ranges, point)]
+
+            lines = sorted(set(row for row, column in points))
+            found = set()
+            for line in lines[:max_count]:
+                found.add(line)
+            return found
+
+    def match_spans(self, i):
+        """The (start, end) columns of the matches the last grep() found on line i"""
+        if i not in self.grep_spans:
+            return []
+        if self.grep_regex is None:
+            return self.grep_spans[i]
+        return [match.span() for match in self.grep_regex.finditer(self.lines[i])]
+
+    def which_patterns(self, patterns, flags, fixed, lines):
+        """
+        Map each of the matching lines to the patterns that match on it. Only
+        the lines the combined pattern found are searched again.
+        """
+        regexes = pattern_regexes(patterns, fixed, flags)
+
+        line_patterns = dict()
+        for i in lines:
+            line = self.lines[i]
+            hits = [pat for pat, regex in regexes if regex.search(line)]
+            if hits:
+                line_patterns[i] = hits
+        return line_patterns
+
+    def grep_buffer(self, regex, multiline, max_count=None):
+        """
+        Run regex over the whole file at once, and map the matches to the lines
+        they are on. Returns the (start, end) columns of the matches on each line,
+        or just the first one if color is off. Stops once max_count lines match.
+        """
+        if not self.lines:
+            return dict()
+
+        text = "\n".join(self.lines)
+        line_starts = [0]
+        line_starts.extend(accumulate(len(line) + 1 for line in self.lines))
+
+        spans = dict()
+        if multiline:
+            for match in regex.finditer(text):
+                start, end = match.span()
+                first = bisect_right(line_starts, start) - 1
+                last = bisect_right(line_starts, max(start, end - 1)) - 1
+                for line in range(first, last + 1):
+                    line_start = line_starts[line]
+                    line_end = line_starts[line + 1] - 1
+                    line_span = (
+                        max(start, line_start) - line_start,
+                        min(end, line_end) - line_start,
+                    )
+                    spans.setdefault(line, []).append(line_span)
+                if max_count and len(spans) >= max_count:
+                    break
+            return spans
+
+        pos = 0
+        while pos <= len(text):
+            match = regex.search(text, pos)
+            if not match:
+                break
+
+            line = bisect_right(line_starts, match.start()) - 1
+            line_start = line_starts[line]
+            line_end = line_starts[line + 1] - 1
+            if match.end() > line_end:
+                # it matched a line break, so try again within just this line
+                match = regex.search(text, match.start(), line_end)
+
+            if match and self.color:
+                spans[line] = [m.span() for m in regex.finditer(self.lines[line])]
+            elif match:
+                spans[line] = [(match.start() - line_start, match.end() - line_start)]
+
+            if len(spans) == max_count:
+                break
+
+            # the rest of the line can't add anything new
+            pos = line_end + 1
+
+        return spans
+
+    def grep_bytes(self, bytes_regex, regex, max_count=None):
+        """
+        Like grep_buffer(), but runs bytes_regex (from compile_bytes()) over the
+        UTF-8 bytes, so the file never has to be decoded. With color on, regex
+        finds the columns to highlight on just the lines that match. Otherwise
+        the columns of the first match are in bytes.
+        """
+        if not self.lines:
+            return dict()
+
+        data = self.data
+
+        # the buffer grep_buffer() would search ends without the last line break
+        end = len(data)
+        if data.endswith(b"\n"):
+            end -= 1
+
+        spans = dict()
+        line = 0
+        line_start = 0
+        pos = 0
+        while pos <= end:
+            match = bytes_regex.search(data, pos, end)
+            if not match:
+                break
+
+            start = match.start()
+            line += data.count(b"\n", line_start, start)
+            line_start = data.rfind(b"\n", 0, start) + 1
+            line_end = data.find(b"\n", start, end)
+            if line_end < 0:
+                line_end = end
+
+            if match.end() > line_end:
+                # it matched a line break, so try again within just this line
+                match = bytes_regex.search(data, start, line_end)
+
+            if match and self.color:
+                spans[line] = [m.span() for m in regex.finditer(self.lines[line])]
+            elif match:
+                spans[line] = [(match.start() - line_start, match.end() - line_start)]
+
+            if len(spans) == max_count:
+                break
+
+            # the rest of the line can't add anything new
+            pos = line_end + 1
+
+        return spans
+
     def add_lines_of_interest(self, line_nums):
         self.lines_of_interest.update(line_nums)
 
+    def add_grep_context(self):
+        """
+        Show just the lines of interest, like plain grep, without parsing. The
+        fallback for files too big or too slow to parse.
+        """
+        self.show_lines = set(self.lines_of_interest)
+
+    @timed("context")
     def add_context(self):
         if not self.lines_of_interest:
             return
@@ -145,7 +885,7 @@ class TreeContext:
         self.close_small_gaps()
 
     def add_child_context(self, i):
-        if not self.nodes[i]:
+        if self.scope_sizes[i] < 0:
             return
 
         last_line = self.get_last_line_of_scope(i)
@@ -154,37 +894,55 @@ class TreeContext:
             self.show_lines.update(range(i, last_line + 1))
             return
 
-        children = []
-        for node in self.nodes[i]:
-            children += self.find_all_children(node)
-
-        children = sorted(
-            children,
-            key=lambda node: node.end_point[0] - node.start_point[0],
-            reverse=True,
-        )
-
         currently_showing = len(self.show_lines)
         max_to_show = 25
         min_to_show = 5
         percent_to_show = 0.10
         max_to_show = max(min(size * percent_to_show, max_to_show), min_to_show)
 
-        for child in children:
+        for child_start_line in self.children_by_size(i):
             if len(self.show_lines) > currently_showing + max_to_show:
                 break
-            child_start_line = child.start_point[0]
             self.add_parent_scopes(child_start_line)
 
-    def find_all_children(self, node):
-        children = [node]
-        for child in node.children:
-            children += self.find_all_children(child)
-        return children
+    def children_by_size(self, i):
+        """
+        Yield line i and each line inside the scope starting on it where a node
+        starts, biggest node first, and in line order for nodes of equal size.
+
+        A node nested inside another one is smaller than it, so the lines are
+        taken lazily from a heap that only holds the lines directly inside the
+        ones already yielded. Taking the first few costs O(k log n), no matter
+        how many nodes the scope holds.
+        """
+        sizes = self.scope_sizes
+        last_line = i + sizes[i]
+
+        heap = [(-sizes[i], i)]
+        if last_line > i and i + self.child_spans[i] == last_line:
+            # only the one-line nodes that close the scope are inside it
+            heap.append((0, last_line))
+
+        while heap:
+            _, line = heapq.heappop(heap)
+            yield line
+
+            if line == last_line:
+                continue
+
+            # the nodes directly inside, skipping over the lines of each one.
+            # One can start on the line the previous one ends on, but not inside it.
+            end = line + sizes[line]
+            child = line + 1
+            while child < end:
+                if sizes[child] < 0:
+                    child += 1
+                    continue
+                heapq.heappush(heap, (-sizes[child], child))
+                child += max(sizes[child], 1)
 
     def get_last_line_of_scope(self, i):
-        last_line = max(node.end_point[0] for node in self.nodes[i])
-        return last_line
+        return i + self.scope_sizes[i]
 
     def close_small_gaps(self):
         # a "closing" operation on the integers in set.
@@ -196,34 +954,44 @@ class TreeContext:
             if sorted_show[i + 1] - sorted_show[i] == 2:
                 closed_show.add(sorted_show[i] + 1)
 
-        # pick up adjacent blank lines
-        for i, line in enumerate(self.lines):
-            if i not in closed_show:
+        # pick up adjacent blank lines, checking just the line after each shown one
+        for i in list(closed_show):
+            if not 0 <= i < self.num_lines - 2:
                 continue
-            if self.lines[i].strip() and i < self.num_lines - 2 and not self.lines[i + 1].strip():
+            if self.lines[i].strip() and not self.lines[i + 1].strip():
                 closed_show.add(i + 1)
 
         self.show_lines = closed_show
 
+    @timed("format", parse=False)
     def format(self):
+        return "".join(self.format_iter())
+
+    def format_iter(self):
+        """
+        Yield the formatted output a line at a time. Only the shown lines are
+        visited, with a single gap marker for each run of hidden lines.
+        """
         if not self.show_lines:
-            return ""
+            return
 
-        output = ""
         if self.color:
             # reset
-            output += "\033[0m\n"
-
-        dots = not (0 in self.show_lines)
-        for i, line in enumerate(self.lines):
-            if i not in self.show_lines:
-                if dots:
-                    if self.line_number:
-                        output += "...⋮...\n"
-                    else:
-                        output += "⋮\n"
-                    dots = False
-                continue
+            yield "\033[0m\n"
+
+        if self.line_number:
+            dots = "...⋮...\n"
+        else:
+            dots = "⋮\n"
+
+        num_lines = len(self.lines)
+        shown = sorted(i for i in self.show_lines if 0 <= i < num_lines)
+
+        prev = -1
+        for i in shown:
+            if i > prev + 1:
+                yield dots
+            prev = i
 
             if i in self.lines_of_interest and self.mark_lois:
                 spacer = "█"
@@ -232,63 +1000,381 @@ class TreeContext:
             else:
                 spacer = "│"
 
-            line_output = f"{spacer}{self.output_lines.get(i, line)}"
+            line = self.lines[i]
+            if self.color:
+                # with the grep highlights, unless color was turned off for a render()
+                line = self.output_lines.get(i, line)
+            line_output = f"{spacer}{line}"
+            if i in self.line_patterns and i in self.lines_of_interest:
+                line_output += self.pattern_tag(self.line_patterns[i])
             if self.line_number:
                 line_output = f"{i + 1: 3}" + line_output
-            output += line_output + "\n"
+            yield line_output + "\n"
+
+        if prev < num_lines - 1:
+            yield dots
+
+    @timed("format", parse=False)
+    def result(self):
+        """
+        What format() would show, as a Result of line numbers and ranges
+        rather than text, which skips building the output entirely.
+        """
+        ranges = gaps = []
+        # like format(), which shows nothing at all, not even a gap, without show_lines
+        if self.show_lines:
+            num_lines = len(self.lines)
+            shown = sorted(i for i in self.show_lines if 0 <= i < num_lines)
+            ranges, gaps = line_ranges(shown, num_lines)
+
+        lois = sorted(self.lines_of_interest)
+        spans = [(i, start, end) for i in lois for start, end in self.match_spans(i)]
+        patterns = [(i, self.line_patterns[i]) for i in lois if i in self.line_patterns]
+
+        return Result(self.filename, lois, ranges, gaps, spans, patterns)
 
-            dots = True
+    def pattern_tag(self, patterns):
+        tag = "  ◀ " + ", ".join(patterns)
+        if self.color:
+            tag = f"\033[36m{tag}\033[0m"
+        return tag
 
-        return output
+    @timed("format", parse=False)
+    def write_to(self, stream):
+        """Write the formatted output to a text stream, or utf8 encoded to a binary one"""
+        binary = not isinstance(stream, io.TextIOBase)
+        for chunk in self.format_iter():
+            stream.write(chunk.encode("utf8") if binary else chunk)
 
     def add_parent_scopes(self, i):
-        if i in self.done_parent_scopes:
+        if self.parent_scope_memo is not None:
+            self.show_lines.update(self.parent_scope_lines(i))
             return
-        self.done_parent_scopes.add(i)
 
-        if i >= len(self.scopes):
-            return
+        # the last lines of scopes still to be expanded, kept on a stack rather
+        # than recursing so deeply nested files can't hit the recursion limit
+        pending = [i]
+        while pending:
+            i = pending.pop()
+            if i in self.done_parent_scopes:
+                continue
+            self.done_parent_scopes.add(i)
+
+            if i >= self.num_lines:
+                continue
+
+            for line_num in self.enclosing_scopes(i):
+                head_start = line_num
+                head_end = line_num + self.header_size(line_num)
+                if head_start > 0 or self.show_top_of_file_parent_scope:
+                    self.show_lines.update(range(head_start, head_end))
+
+                if self.last_line:
+                    pending.append(self.get_last_line_of_scope(line_num))
 
-        for line_num in self.scopes[i]:
-            head_start, head_end = self.header[line_num]
-            if head_start > 0 or self.show_top_of_file_parent_scope:
-                self.show_lines.update(range(head_start, head_end))
+    def parent_scope_lines(self, i):
+        """
+        The lines add_parent_scopes(i) shows, memoized in parent_scope_memo.
+        They're the headers of the scopes around i plus, with last_line, the
+        lines shown for the last line of each of those scopes, so those are
+        worked out (and memoized) first.
+        """
+        memo = self.parent_scope_memo
+        pending = [i]
+        while pending:
+            line = pending[-1]
+            if line in memo:
+                pending.pop()
+                continue
+
+            if line >= self.num_lines:
+                memo[line] = frozenset()
+                pending.pop()
+                continue
 
+            scopes = list(self.enclosing_scopes(line))
+            last_lines = []
             if self.last_line:
-                last_line = self.get_last_line_of_scope(line_num)
-                self.add_parent_scopes(last_line)
-
-    def walk_tree(self, node, depth=0):
-        start = node.start_point
-        end = node.end_point
-
-        start_line = start[0]
-        end_line = end[0]
-        size = end_line - start_line
-
-        self.nodes[start_line].append(node)
-
-        # dump(start_line, end_line, node.text)
-        if self.verbose and node.is_named:
-            """
-            for k in dir(node):
-                print(k, getattr(node, k))
-            """
-            print(
-                "   " * depth,
-                node.type,
-                f"{start_line}-{end_line}={size + 1}",
-                node.text.splitlines()[0],
-                self.lines[start_line],
-            )
-
-        if size:
-            self.header[start_line].append((size, start_line, end_line))
-
-        for i in range(start_line, end_line + 1):
-            self.scopes[i].add(start_line)
-
-        for child in node.children:
-            self.walk_tree(child, depth + 1)
-
-        return start_line, end_line
+                last_lines = [self.get_last_line_of_scope(start) for start in scopes]
+                # a scope ending on line itself adds nothing its own scopes don't
+                last_lines = [last for last in last_lines if last != line]
+                missing = [last for last in last_lines if last not in memo]
+                if missing:
+                    pending.extend(missing)
+                    continue
+
+            lines = set()
+            for line_num in scopes:
+                if line_num > 0 or self.show_top_of_file_parent_scope:
+                    lines.update(range(line_num, line_num + self.header_size(line_num)))
+            for last in last_lines:
+                lines.update(memo[last])
+
+            memo[line] = frozenset(lines)
+            pending.pop()
+
+        return memo[i]
+
+    def render(self, lois, structured=False, **options):
+        """
+        Return the formatted context for the lines of interest lois, leaving
+        this TreeContext's own lines of interest and shown lines untouched.
+        options override the display options given to __init__ for this call.
+        With structured=True, return it as a Result instead.
+        """
+        return self.render_many([lois], structured, **options)[0]
+
+    def render_many(self, loi_sets, structured=False, **options):
+        """
+        Like render(), for each set of lines of interest in loi_sets. The parse
+        and the parent scopes found for each line are shared between them, and
+        with later calls that use the same options.
+        With structured=True, each comes back as a Result instead of text.
+        """
+        view = self.render_view(options)
+
+        outputs = []
+        for lois in loi_sets:
+            view.show_lines = set()
+            view.lines_of_interest = set()
+            view.add_lines_of_interest(lois)
+            view.add_context()
+            outputs.append(view.result() if structured else view.format())
+        return outputs
+
+    def render_view(self, options):
+        unknown = set(options) - set(RENDER_OPTIONS)
+        if unknown:
+            raise TypeError(f"unknown render options: {', '.join(sorted(unknown))}")
+
+        # a shallow copy shares the tables, the lines and the grep highlights
+        self.parse()
+        view = copy.copy(self)
+        for name, value in options.items():
+            setattr(view, name, value)
+
+        key = (view.last_line, view.show_top_of_file_parent_scope)
+        view.parent_scope_memo = self.parent_scope_memos.setdefault(key, dict())
+        return view
+
+    def walk_tree(self, node):
+        """
+        Record the scope size, header node sizes and child span of every node
+        under node, and the scope parent of each line up to the last node. The
+        walk uses a cursor and keeps only the start lines of the current node's
+        ancestors, so no Node objects outlive it and deep trees can't hit the
+        recursion limit. Returns the number of nodes visited.
+        """
+        scope_sizes = self.scope_sizes
+        child_spans = self.child_spans
+        header_mins = self.header_mins
+        parents = self.scope_parents
+
+        # the lines where the scopes that may reach next_line start, innermost last
+        open_scopes = []
+        next_line = 0
+
+        cursor = node.walk()
+        ancestors = []
+        walked = 0
+        while True:
+            walked += 1
+            node = cursor.node
+            start_line = node.start_point[0]
+            end_line = node.end_point[0]
+            size = end_line - start_line
+
+            if start_line >= next_line:
+                # Nodes come in order, so every scope starting before this line
+                # is complete and the parents up to it are known
+                for line in range(next_line, start_line + 1):
+                    while open_scopes and open_scopes[-1] + scope_sizes[open_scopes[-1]] < line:
+                        open_scopes.pop()
+                    parents[line] = open_scopes[-1] if open_scopes else -1
+                open_scopes.append(start_line)
+                next_line = start_line + 1
+
+            if size > scope_sizes[start_line]:
+                scope_sizes[start_line] = size
+
+            # dump(start_line, end_line, node.text)
+            if self.verbose and node.is_named:
+                print(
+                    "   " * len(ancestors),
+                    node.type,
+                    f"{start_line}-{end_line}={size + 1}",
+                    node.text.splitlines()[0],
+                    self.lines[start_line],
+                )
+
+            if size:
+                # add_header_node(), inlined as this runs for every node
+                smallest = header_mins[start_line]
+                if not smallest:
+                    header_mins[start_line] = -size
+                elif smallest < 0:
+                    header_mins[start_line] = size if size < -smallest else -smallest
+                elif size < smallest:
+                    header_mins[start_line] = size
+
+            # A node on one line can only hold nodes on that line, which add
+            # nothing to the tables, so only multi-line nodes are walked into
+            if (size or self.verbose) and cursor.goto_first_child():
+                ancestors.append(start_line)
+                continue
+
+            # The last node in a subtree starts on the last line any of its nodes start on
+            last_start = start_line
+            if child_spans[start_line] < 0:
+                child_spans[start_line] = 0
+
+            while not cursor.goto_next_sibling():
+                if not cursor.goto_parent():
+                    return walked
+                start_line = ancestors.pop()
+                if last_start - start_line > child_spans[start_line]:
+                    child_spans[start_line] = last_start - start_line
+
+
+def add_header_node(header_mins, line, size):
+    """Record a multi-line node of size starting on line in header_mins"""
+    smallest = header_mins[line]
+    if not smallest:
+        header_mins[line] = -size
+    elif smallest < 0:
+        header_mins[line] = min(-smallest, size)
+    elif size < smallest:
+        header_mins[line] = size
+
+
+def in_ranges(ranges, point):
+    """True if point is in one of the ranges from query_ranges()"""
+    starts, ends = ranges
+    i = bisect_right(starts, point) - 1
+    return i >= 0 and point < ends[i]
+
+
+# Searches that use the same patterns for every file rewrite and compile
+# them once. A few searches' worth, for the --serve daemon.
+PATTERN_CACHE_SIZE = 32
+
+
+@lru_cache(maxsize=PATTERN_CACHE_SIZE)
+def pattern_source(patterns, fixed=False):
+    """
+    One regex that matches wherever any of the tuple of patterns does. With
+    fixed=True the patterns are literal strings.
+    """
+    if fixed:
+        patterns = [re.escape(pat) for pat in patterns]
+    if len(patterns) == 1:
+        return patterns[0]
+
+    # grouped, so a pattern's own alternatives stay within it
+    alternatives = []
+    groups = 0
+    for k, pat in enumerate(patterns):
+        alternatives.append(f"(?:{alternative_source(pat, k, groups)})")
+        groups += re.compile(pat).groups
+    return "|".join(alternatives)
+
+
+@lru_cache(maxsize=PATTERN_CACHE_SIZE)
+def pattern_regexes(patterns, fixed, flags):
+    """Each of the tuple of patterns with its own compiled regex, for which_patterns()"""
+    return [(pat, re.compile(re.escape(pat) if fixed else pat, flags)) for pat in patterns]
+
+
+def alternative_source(pat, k, offset):
+    """
+    Pattern k of several, rewritten to follow the offset capture groups of
+    the ones before it in a single regex: its backreferences renumbered, its
+    group names made unique and its global inline flags scoped to it
+    """
+    flags = ""
+    pieces = []
+    for match in REGEX_TOKEN.finditer(pat):
+        token = match.group()
+        if match["flags"] and len(pieces) == 0:
+            flags += match["flags"]
+            continue
+        if match["backref"]:
+            group = int(match["backref"]) + offset
+            if group > 99:
+                raise re.error("too many groups to combine the patterns' backreferences")
+            # grouped, so a digit after it doesn't join the number
+            token = f"(?:\\{group})"
+        elif match["group"] and k:
+            token = f"(?P<{match['group']}__{k}>"
+        elif match["name_ref"] and k:
+            token = f"(?P={match['name_ref']}__{k})"
+        elif match["cond"]:
+            ref = match["cond"]
+            ref = str(int(ref) + offset) if ref.isdigit() else f"{ref}__{k}" if k else ref
+            token = f"(?({ref})"
+        pieces.append(token)
+
+    source = "".join(pieces)
+    if flags:
+        # a verbose pattern could end in a comment
+        end = "\n)" if "x" in flags else ")"
+        source = f"(?{flags}:{source}{end}"
+    return source
+
+
+def highlight(line, spans):
+    """Color the (start, end) spans of line"""
+    pieces = []
+    pos = 0
+    for start, end in spans:
+        pieces += (line[pos:start], "\033[1;31m", line[start:end], "\033[0m")
+        pos = end
+    pieces.append(line[pos:])
+    return "".join(pieces)
+
+
+def last_node_start(node):
+    """The line the last node of node's subtree starts on"""
+    while node.child_count:
+        node = node.child(node.child_count - 1)
+    return node.start_point[0]
+
+
+def first_child_ending_after(node, line):
+    """Index of node's first child that ends after line, by binary search"""
+    lo, hi = 0, node.child_count
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if node.child(mid).end_point[0] > line:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+
+def byte_to_point(code, byte):
+    row = code.count(b"\n", 0, byte)
+    column = byte - (code.rfind(b"\n", 0, byte) + 1)
+    return row, column
+
+
+def common_prefix_len(a, b):
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def common_suffix_len(a, b, limit):
+    lo, hi = 0, limit
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len(a) - mid :] == b[len(b) - mid :]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
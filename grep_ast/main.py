@@ -1,15 +1,19 @@
 #!/usr/bin/env python
 
 import argparse
+import json
 import os
 import sys
-from pathlib import Path
-
-import pathspec
+import time
+from itertools import islice
 
+from .cache import DEFAULT_MAX_SIZE, ScopeCache
 from .dump import dump  # noqa: F401
-from .grep_ast import TreeContext
 from .parsers import PARSERS
+from .search import search_file, search_files
+from .stats import Stats
+from .tsl import InvalidQuery
+from .walk import enumerate_files
 
 
 def main():
@@ -19,7 +23,50 @@ def main():
     parser.add_argument("filenames", nargs="*", help="the files to display", default=".")
     parser.add_argument("--encoding", default="utf8", help="file encoding")
     parser.add_argument("--languages", action="store_true", help="show supported languages")
+    parser.add_argument(
+        "-e",
+        "--regexp",
+        action="append",
+        default=[],
+        metavar="PATTERN",
+        help="a pattern to search for, which can be given more than once",
+    )
+    parser.add_argument(
+        "-f",
+        "--file",
+        action="append",
+        default=[],
+        metavar="FILE",
+        help="search for the patterns in FILE, one per line",
+    )
+    parser.add_argument(
+        "-F", "--fixed-strings", action="store_true", help="treat the patterns as literal strings"
+    )
+    parser.add_argument(
+        "--query",
+        help=(
+            "a tree-sitter query; without -e or -f the lines its captures start on are shown,"
+            " otherwise it acts like --in"
+        ),
+    )
+    parser.add_argument(
+        "--in",
+        type=node_types,
+        dest="inside",
+        metavar="TYPES",
+        help="only show matches inside nodes of these comma separated types",
+    )
+    parser.add_argument(
+        "--not-in",
+        type=node_types,
+        dest="outside",
+        metavar="TYPES",
+        help="ignore matches inside nodes of these comma separated types, like comment,string",
+    )
     parser.add_argument("-i", "--ignore-case", action="store_true", help="ignore case distinctions")
+    parser.add_argument(
+        "-U", "--multiline", action="store_true", help="let matches span multiple lines"
+    )
     parser.add_argument("--color", action="store_true", help="force color printing", default=None)
     parser.add_argument(
         "--no-color", action="store_false", help="disable color printing", dest="color"
@@ -27,83 +74,333 @@ def main():
     parser.add_argument("--no-gitignore", action="store_true", help="ignore .gitignore file")
     parser.add_argument("--verbose", action="store_true", help="enable verbose output")
     parser.add_argument("-n", "--line-number", action="store_true", help="display line numbers")
+    parser.add_argument(
+        "-l",
+        "--files-with-matches",
+        action="store_true",
+        help="only print the names of files that match, without parsing them",
+    )
+    parser.add_argument(
+        "-c",
+        "--count",
+        action="store_true",
+        help="only print the number of matching lines in each file, without parsing them",
+    )
+    parser.add_argument(
+        "--json",
+        action="store_true",
+        help="print a JSON object per matching file, with the lines to show rather than the text",
+    )
+    parser.add_argument(
+        "-m",
+        "--max-count",
+        type=positive_int,
+        metavar="N",
+        help="stop searching each file after N matching lines",
+    )
+    parser.add_argument(
+        "--limit", type=positive_int, metavar="N", help="stop searching after N files match"
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=0,
+        help="number of files to search in parallel (default: one per CPU)",
+    )
+    parser.add_argument("--cache-dir", help="cache parsed scope tables in this directory")
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=DEFAULT_MAX_SIZE // (1024 * 1024),
+        help="maximum size of the cache in MB (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max-filesize",
+        type=parse_size,
+        metavar="SIZE",
+        help="skip files bigger than SIZE bytes, which can end in K, M or G",
+    )
+    parser.add_argument(
+        "--parse-timeout",
+        type=float,
+        default=5.0,
+        metavar="SECONDS",
+        help="show files that take longer to parse like grep would (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max-lines",
+        type=int,
+        metavar="N",
+        help="show files of more than N lines like grep would, without parsing them",
+    )
+    parser.add_argument(
+        "--max-line-length",
+        type=int,
+        default=10_000,
+        metavar="N",
+        help=(
+            "show files with lines longer than N, like minified code, like grep would"
+            " (default: %(default)s)"
+        ),
+    )
+    parser.add_argument(
+        "--stats", action="store_true", help="print timings and counts to stderr when done"
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="run a daemon that keeps this directory's files parsed, for --client searches",
+    )
+    parser.add_argument(
+        "--client",
+        action="store_true",
+        help="search with the --serve daemon for this directory, if it's running",
+    )
+    parser.add_argument("--socket", help="the daemon's socket (default: one per directory)")
     args = parser.parse_args()
 
     # If stdout is not a terminal, set color to False
     if args.color is None:
         args.color = os.isatty(1)
+    if args.json:
+        args.color = False
 
     # If --languages is provided, print the parsers table and exit
     if args.languages:
         for ext, lang in sorted(PARSERS.items()):
             print(f"{ext}: {lang}")
         return
-    elif not args.pattern:
+    elif args.serve:
+        # imported here, like the client side below, as only these modes need it
+        from .server import default_socket_path, serve
+
+        return serve(args.socket or default_socket_path())
+
+    args.pattern = get_patterns(args)
+    if args.query and args.inside:
+        print("--query and --in can't be used together")
+        return 1
+    if not args.pattern and not args.query:
         print("Please provide a pattern to search for")
         return 1
 
-    gitignore = None
-    if not args.no_gitignore:
-        for parent in Path("./xxx").resolve().parents:
-            potential_gitignore = parent / ".gitignore"
-            if potential_gitignore.exists():
-                gitignore = potential_gitignore
-                break
+    if args.client:
+        answers = ask_daemon(args)
+        # with no daemon running, just search here
+        if answers is not None:
+            ignored = client_ignored(args)
+            if ignored:
+                print(f"Ignoring {', '.join(ignored)} in a --client search", file=sys.stderr)
+            return print_answers(answers)
+
+    start = time.perf_counter()
+    stats = Stats() if args.stats else None
+
+    fnames = enumerate_files(args.filenames, gitignore=not args.no_gitignore)
+    if stats:
+        fnames = stats.time_iter(fnames, "enumerate")
+
+    mode = output_mode(args)
+    options = search_options(args)
+    results = search_files(
+        fnames, args.pattern, jobs=args.jobs, stats=stats, count=mode != "context", **options
+    )
+    # closing the results early stops the search, and cancels any files in flight
+    try:
+        for fname, result in islice(results, args.limit):
+            write_output(result_text(fname, result, mode, args.json))
+    except InvalidQuery as err:
+        print(err, file=sys.stderr)
+        return 1
+    finally:
+        results.close()
+
+    if stats:
+        print(stats.report(time.perf_counter() - start), file=sys.stderr)
+
+
+def get_patterns(args):
+    """
+    The pattern to search for, or a list of them from -e and -f. Like grep,
+    with either of those, or --query, the first positional argument is a
+    filename. None if --query is all there is to search for.
+    """
+    if not args.regexp and not args.file and not args.query:
+        return args.pattern
+
+    patterns = list(args.regexp)
+    for fname in args.file:
+        with open(fname, encoding=args.encoding) as file:
+            patterns += [line for line in file.read().splitlines() if line]
 
-    if gitignore:
-        with gitignore.open() as f:
-            spec = pathspec.PathSpec.from_lines("gitwildmatch", f)
-    else:
-        spec = pathspec.PathSpec.from_lines("gitwildmatch", [])
+    if args.pattern:
+        # filenames is the "." default if none were given
+        filenames = [] if isinstance(args.filenames, str) else args.filenames
+        args.filenames = [args.pattern] + filenames
+    return patterns or None
 
-    for fname in enumerate_files(args.filenames, spec):
-        process_filename(fname, args)
 
+def node_types(text):
+    """The node types from --in or --not-in, as TreeContext.grep() takes them"""
+    return tuple(name.strip() for name in text.split(",") if name.strip())
+
+
+def ask_daemon(args):
+    """Send the search to the --serve daemon, and return its answers, or None if it's not running"""
+    from .server import default_socket_path, forward
+
+    request = dict(
+        cwd=os.getcwd(),
+        pattern=args.pattern,
+        filenames=args.filenames,
+        gitignore=not args.no_gitignore,
+        ignore_case=args.ignore_case,
+        multiline=args.multiline,
+        fixed=args.fixed_strings,
+        encoding=args.encoding,
+        color=args.color,
+        line_number=args.line_number,
+        max_count=max_count(args),
+        inside=args.query or args.inside,
+        outside=args.outside,
+        max_filesize=args.max_filesize,
+        parse_timeout=args.parse_timeout or None,
+        max_lines=args.max_lines,
+        max_line_length=args.max_line_length or None,
+        mode=output_mode(args),
+        json=args.json,
+        limit=args.limit,
+    )
+    try:
+        return forward(args.socket or default_socket_path(), request)
+    except PermissionError as err:
+        print(f"Not using the daemon: {err}", file=sys.stderr)
+    except OSError:
+        pass
 
-def enumerate_files(fnames, spec, use_spec=False):
-    for fname in fnames:
-        fname = Path(fname)
 
-        # oddly, Path('.').name == "" so we will recurse it
-        if fname.name.startswith(".") or use_spec and spec.match_file(fname):
-            continue
+def client_ignored(args):
+    """The options given that only work in a local search, not with the daemon"""
+    options = dict(stats="--stats", verbose="--verbose", cache_dir="--cache-dir")
+    return [option for name, option in options.items() if getattr(args, name)]
 
-        if fname.is_file():
-            yield str(fname)
-            continue
 
-        if fname.is_dir():
-            for sub_fnames in enumerate_files(fname.iterdir(), spec, True):
-                yield sub_fnames
+def print_answers(answers):
+    for kind, text in answers:
+        if kind == "error":
+            print(f"gast --serve: {text}", file=sys.stderr)
+            return 1
+        write_output(text)
 
 
 def process_filename(filename, args):
+    output = search_file(filename, args.pattern, **search_options(args))
+    if output:
+        print_output(filename, output)
+
+
+def output_mode(args):
+    """What to print for each matching file: "context", "count" or "files" """
+    if args.files_with_matches:
+        return "files"
+    if args.count:
+        return "count"
+    return "context"
+
+
+def search_options(args):
+    cache = None
+    if args.cache_dir:
+        cache = ScopeCache(args.cache_dir, args.cache_size * 1024 * 1024)
+
+    options = dict(
+        ignore_case=args.ignore_case,
+        multiline=args.multiline,
+        fixed=args.fixed_strings,
+        encoding=args.encoding,
+        color=args.color and output_mode(args) == "context",
+        verbose=args.verbose,
+        line_number=args.line_number,
+        max_count=max_count(args),
+        inside=args.query or args.inside,
+        outside=args.outside,
+        max_filesize=args.max_filesize,
+        parse_timeout=args.parse_timeout or None,
+        max_lines=args.max_lines,
+        max_line_length=args.max_line_length or None,
+        cache=cache,
+    )
+    if output_mode(args) == "context":
+        options["structured"] = args.json
+    return options
+
+
+def parse_size(text):
+    """A size in bytes, like 100, 20K, 1.5M or 2G"""
+    units = dict(K=1024, M=1024**2, G=1024**3)
+    scale = units.get(text[-1:].upper())
     try:
-        with open(filename, "r", encoding=args.encoding) as file:
-            code = file.read()
-    except UnicodeDecodeError:
-        return
+        if scale:
+            return int(float(text[:-1]) * scale)
+        return int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size: {text!r}")
 
+
+def positive_int(text):
+    """A count of 1 or more, for options where 0 would find nothing"""
     try:
-        tc = TreeContext(
-            filename, code, color=args.color, verbose=args.verbose, line_number=args.line_number
-        )
+        value = int(text)
     except ValueError:
-        return
+        value = 0
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"not a positive number: {text!r}")
+    return value
 
-    loi = tc.grep(args.pattern, args.ignore_case)
-    if not loi:
-        return
 
-    tc.add_lines_of_interest(loi)
-    tc.add_context()
+def max_count(args):
+    # one matching line is enough to know a file matches
+    if args.files_with_matches:
+        return 1
+    return args.max_count
+
 
-    print()
-    print(f"{filename}:")
+def result_text(filename, result, mode="context", as_json=False):
+    """
+    The text printed for a file's result, which is search_file()'s output
+    in "context" mode, and count_file()'s count in the others. With
+    as_json=True it's a line of JSON, and the output is a Result.
+    """
+    if as_json:
+        if mode == "context":
+            record = result.to_dict()
+        else:
+            record = dict(filename=filename)
+        if mode == "count":
+            record["count"] = result
+        return json.dumps(record) + "\n"
 
-    print(tc.format(), end="")
+    if mode == "files":
+        return f"{filename}\n"
+    if mode == "count":
+        return f"{filename}:{result}\n"
+    return f"\n{filename}:\n{result}\n"
+
+
+def print_output(filename, output):
+    write_output(result_text(filename, output))
+
+
+def write_output(text):
+    stdout = getattr(sys.stdout, "buffer", None)
+    if not stdout:
+        sys.stdout.write(text)
+        return
 
-    print()
+    # skip the text layer, but flush it first to keep anything printed in order
+    sys.stdout.flush()
+    stdout.write(text.encode(sys.stdout.encoding, sys.stdout.errors))
 
 
 if __name__ == "__main__":
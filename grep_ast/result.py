@@ -0,0 +1,58 @@
+from .dump import dump  # noqa: F401
+
+
+class Result:
+    """
+    What a TreeContext shows, as line numbers rather than formatted text, for
+    callers that slice the source themselves. Lines are numbered from 0, and
+    every (start, end) range excludes its end.
+
+    lines_of_interest: the lines of interest, in order
+    shown: the (start, end) ranges of the lines shown
+    gaps: the (start, end) ranges of the lines hidden, which format() shows
+        as a single gap marker each
+    spans: a (line, start, end) for each match, with start and end columns
+    patterns: a (line, patterns) for each line of interest, with the patterns
+        that hit it, when searching for several at once
+    """
+
+    __slots__ = ("filename", "lines_of_interest", "shown", "gaps", "spans", "patterns")
+
+    def __init__(self, filename, lines_of_interest, shown, gaps, spans, patterns):
+        self.filename = filename
+        self.lines_of_interest = lines_of_interest
+        self.shown = shown
+        self.gaps = gaps
+        self.spans = spans
+        self.patterns = patterns
+
+    def __repr__(self):
+        return f"Result({self.filename!r}, shown={self.shown!r})"
+
+    def to_dict(self):
+        """The result as plain lists and dicts, ready for json.dumps()"""
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+def line_ranges(lines, num_lines):
+    """
+    The (start, end) ranges of the sorted lines, and of the gaps between them
+    in range(num_lines)
+    """
+    ranges = []
+    for i in lines:
+        if ranges and ranges[-1][1] == i:
+            ranges[-1] = (ranges[-1][0], i + 1)
+        else:
+            ranges.append((i, i + 1))
+
+    gaps = []
+    prev_end = 0
+    for start, end in ranges:
+        if start > prev_end:
+            gaps.append((prev_end, start))
+        prev_end = end
+    if prev_end < num_lines:
+        gaps.append((prev_end, num_lines))
+
+    return ranges, gaps
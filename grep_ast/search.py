@@ -0,0 +1,392 @@
+import codecs
+import os
+import re
+from collections import deque
+from functools import lru_cache, partial
+from itertools import chain, islice
+
+from .dump import dump  # noqa: F401
+from .grep_ast import ParseLimitError, TreeContext, pattern_source
+from .stats import Stats, phase_timer
+from .utf8 import compile_bytes, has_odd_line_breaks, is_binary
+
+# Below this many files, starting a pool costs more than it saves
+MIN_PARALLEL_FILES = 32
+
+# How many files each worker may have queued ahead of the one being printed
+PREFETCH_PER_JOB = 4
+
+# \A, \Z and negative lookarounds don't mean the same thing on a whole file
+WHOLE_FILE_UNSAFE = re.compile(r"\\[AZ]|\(\?<?!")
+
+
+def may_match(code, pat, ignore_case, fixed=False):
+    """
+    Cheap whole-file check: False only if no line of code can match pat, or
+    any of a list of patterns (literal strings with fixed=True).
+    code can be str, or UTF-8 bytes which are only decoded if pat needs it.
+    """
+    pat = pattern_source((pat,) if isinstance(pat, str) else tuple(pat), fixed)
+    if WHOLE_FILE_UNSAFE.search(pat):
+        return True
+
+    flags = re.MULTILINE
+    if ignore_case:
+        flags |= re.IGNORECASE
+
+    regex = None
+    if isinstance(code, bytes):
+        regex = compile_bytes(pat, flags, code)
+        if not regex:
+            code = code.decode("utf8", "replace")
+    if not regex:
+        regex = re.compile(pat, flags)
+
+    if regex.search(code):
+        return True
+
+    # "^" or "$" could match right after/before one of these in a line-by-line search
+    return has_odd_line_breaks(code)
+
+
+def search_file(
+    filename,
+    pattern,
+    ignore_case=False,
+    encoding="utf8",
+    multiline=False,
+    max_count=None,
+    fixed=False,
+    inside=None,
+    outside=None,
+    max_filesize=None,
+    structured=False,
+    stats=None,
+    **kwargs,
+):
+    """
+    Grep one file and return its formatted TreeContext output, or None if
+    the file doesn't match or can't be read or parsed. With max_count, only
+    the first max_count matching lines are shown.
+    pattern can be a list of patterns to search for at once, and fixed=True
+    makes them literal strings, as in TreeContext.grep().
+    inside and outside filter the matches by the nodes they're in, also as
+    in TreeContext.grep(). With no pattern, the lines of interest are where
+    the nodes captured by the query inside start, and not inside outside.
+
+    Files over max_filesize bytes are skipped. Files over the TreeContext
+    parse limits (parse_timeout, max_lines, max_line_length) are shown like
+    plain grep would, with just the matching lines.
+    With structured=True, return the TreeContext's result(), which lists the
+    lines shown rather than formatting them.
+    Extra keyword arguments are passed on to TreeContext.
+    """
+    found = grep_file(
+        filename,
+        pattern,
+        ignore_case,
+        encoding,
+        multiline,
+        max_count,
+        fixed,
+        inside,
+        outside,
+        max_filesize,
+        stats,
+        kwargs,
+    )
+    if not found:
+        return
+
+    tc, loi = found
+    tc.add_lines_of_interest(loi)
+    try:
+        tc.add_context()
+    except ParseLimitError:
+        if stats is not None:
+            stats.count("degraded")
+        tc.add_grep_context()
+
+    if structured:
+        return tc.result()
+    return tc.format()
+
+
+def count_file(
+    filename,
+    pattern,
+    ignore_case=False,
+    encoding="utf8",
+    multiline=False,
+    max_count=None,
+    fixed=False,
+    inside=None,
+    outside=None,
+    max_filesize=None,
+    stats=None,
+    **kwargs,
+):
+    """
+    Count the lines of one file that match, up to max_count, without parsing
+    it unless inside or outside need it. Returns 0 for the files
+    search_file() would return None for.
+    """
+    found = grep_file(
+        filename,
+        pattern,
+        ignore_case,
+        encoding,
+        multiline,
+        max_count,
+        fixed,
+        inside,
+        outside,
+        max_filesize,
+        stats,
+        kwargs,
+    )
+    if not found:
+        return 0
+
+    tc, loi = found
+    return len(loi)
+
+
+def grep_file(
+    filename,
+    pattern,
+    ignore_case,
+    encoding,
+    multiline,
+    max_count,
+    fixed,
+    inside,
+    outside,
+    max_filesize,
+    stats,
+    kwargs,
+):
+    """
+    Read and grep one file, returning its (unparsed) TreeContext and lines of
+    interest, or None if it doesn't match or can't be searched.
+    """
+    if stats is not None:
+        stats.count("scanned")
+
+    with phase_timer(stats, "read"):
+        code = read_source(filename, encoding, stats, max_filesize)
+    if code is None:
+        if stats is not None:
+            stats.count("skipped")
+        return
+
+    # Most files don't match at all, so check the raw text before paying for the parse
+    if pattern is not None:
+        with phase_timer(stats, "grep"):
+            if not may_match(code, pattern, ignore_case, fixed):
+                return
+
+    # Only now that it matches, make sure it was valid UTF-8 all along
+    if not is_decodable(code):
+        if stats is not None:
+            stats.count("skipped")
+        return
+
+    try:
+        tc = TreeContext(filename, code, stats=stats, **kwargs)
+    except ValueError:
+        if stats is not None:
+            stats.count("skipped")
+        return
+
+    try:
+        if pattern is None:
+            loi = tc.query(inside, max_count, outside)
+        else:
+            loi = tc.grep(pattern, ignore_case, multiline, max_count, fixed, inside, outside)
+    except ParseLimitError:
+        # the nodes to filter matches by aren't known without the parse
+        if stats is not None:
+            stats.count("skipped")
+        return
+    if not loi:
+        return
+
+    if stats is not None:
+        stats.count("matched")
+
+    return tc, loi
+
+
+def read_source(filename, encoding, stats=None, max_size=None):
+    """
+    Read a file in one go. UTF-8 files come back as bytes, which are searched
+    and parsed without decoding them, other encodings as str. Returns None
+    for binary files, files that aren't in the encoding and files over
+    max_size bytes, which aren't read at all.
+    """
+    with open(filename, "rb") as file:
+        if max_size and os.fstat(file.fileno()).st_size > max_size:
+            if stats is not None:
+                stats.count("oversized")
+            return
+        data = file.read()
+
+    if stats is not None:
+        stats.count("bytes", len(data))
+
+    if is_ascii_compatible(encoding) and is_binary(data):
+        if stats is not None:
+            stats.count("binary")
+        return
+
+    if is_utf8(encoding):
+        # the same newline translation as reading in text mode
+        if b"\r" in data:
+            data = data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+        return data
+
+    try:
+        code = data.decode(encoding)
+    except UnicodeDecodeError:
+        return
+    return code.replace("\r\n", "\n").replace("\r", "\n")
+
+
+def is_decodable(code):
+    """False if code is bytes that aren't valid UTF-8"""
+    if not isinstance(code, bytes) or code.isascii():
+        return True
+    try:
+        code.decode("utf8")
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+@lru_cache(maxsize=None)
+def is_utf8(encoding):
+    return codecs.lookup(encoding).name == "utf-8"
+
+
+@lru_cache(maxsize=None)
+def is_ascii_compatible(encoding):
+    """True if encoding stores ASCII as ASCII, so a NUL byte is really a NUL"""
+    try:
+        return "\0\na".encode(encoding) == b"\0\na"
+    except UnicodeError:
+        return False
+
+
+def search_file_with_stats(filename, pattern, search=search_file, **kwargs):
+    """search(), like search_file(), with a Stats of its own, returned along with its result"""
+    stats = Stats()
+    return search(filename, pattern, stats=stats, **kwargs), stats
+
+
+def file_searcher(pattern, count, stats, kwargs):
+    """The function of a filename that search_files() maps over the files"""
+    search = count_file if count else search_file
+    if stats is None:
+        return partial(search, pattern=pattern, **kwargs)
+
+    # each file is timed on its own and merged in here, as it may have
+    # been searched in another process
+    return partial(search_file_with_stats, pattern=pattern, search=search, **kwargs)
+
+
+def search_files(filenames, pattern, jobs=1, threads=False, stats=None, count=False, **kwargs):
+    """
+    Search many files, yielding (filename, output) for each file that matches.
+    With count=True, yield (filename, count_file()) instead, without parsing.
+
+    Results come back in the order of filenames and are yielded as soon as
+    each file's turn comes. With jobs > 1 (or jobs=None/0 for one per CPU)
+    the files are searched in a process pool, or a thread pool if threads=True.
+    Takes the same keyword arguments as search_file().
+    """
+    search = file_searcher(pattern, count, stats, kwargs)
+
+    results = ordered_map(search, filenames, jobs, threads)
+    for filename, output in results:
+        if stats is not None:
+            output, file_stats = output
+            stats.merge(file_stats)
+        if output:
+            yield filename, output
+
+
+async def search_files_async(
+    filenames, pattern, jobs=0, executor=None, stats=None, count=False, **kwargs
+):
+    """
+    Like search_files(), as an async iterator for use inside an asyncio event
+    loop, which never blocks on reading or parsing a file.
+
+    Each file is searched with run_in_executor(), in executor or the loop's
+    default one, with at most jobs files in flight (jobs=0 for one per CPU).
+    Threads still share the GIL with the loop, so a ProcessPoolExecutor keeps
+    the loop most responsive.
+    Results come back in the order of filenames. Closing the iterator, or
+    cancelling the task that consumes it, cancels the searches not yet started.
+    """
+    # imported here, as it's slow to import and only async callers need it
+    import asyncio
+
+    if not jobs:
+        jobs = os.cpu_count() or 1
+
+    search = file_searcher(pattern, count, stats, kwargs)
+
+    loop = asyncio.get_running_loop()
+    filenames = iter(filenames)
+    pending = deque()
+    try:
+        while True:
+            for filename in islice(filenames, jobs - len(pending)):
+                pending.append((filename, loop.run_in_executor(executor, search, filename)))
+            if not pending:
+                return
+
+            filename, future = pending.popleft()
+            output = await future
+            if stats is not None:
+                output, file_stats = output
+                stats.merge(file_stats)
+            if output:
+                yield filename, output
+    finally:
+        for filename, future in pending:
+            future.cancel()
+
+
+def ordered_map(func, items, jobs=1, threads=False):
+    """Yield (item, func(item)) in order, running func in a pool when it's worthwhile."""
+    if not jobs:
+        jobs = os.cpu_count() or 1
+
+    items = iter(items)
+    head = list(islice(items, MIN_PARALLEL_FILES))
+    if jobs <= 1 or len(head) < MIN_PARALLEL_FILES:
+        for item in chain(head, items):
+            yield item, func(item)
+        return
+
+    # imported here, as most runs never need a pool and it's slow to import
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+    executor_class = ThreadPoolExecutor if threads else ProcessPoolExecutor
+    executor = executor_class(max_workers=jobs)
+    pending = deque()
+    try:
+        for item in chain(head, items):
+            pending.append((item, executor.submit(func, item)))
+            while pending and (len(pending) >= jobs * PREFETCH_PER_JOB or pending[0][1].done()):
+                item, future = pending.popleft()
+                yield item, future.result()
+
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
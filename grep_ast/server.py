@@ -0,0 +1,281 @@
+import hashlib
+import json
+import os
+import socket
+import socketserver
+import sys
+import traceback
+from itertools import islice
+
+from .dump import dump  # noqa: F401
+from .grep_ast import ParseLimitError, TreeContext
+from .main import result_text
+from .search import is_decodable, may_match, read_source
+from .walk import enumerate_files
+
+
+def default_socket_path(dirname="."):
+    """The socket of the daemon serving dirname, unique per user and directory"""
+    key = hashlib.sha1(os.path.abspath(dirname).encode("utf8")).hexdigest()[:16]
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or os.environ.get("TMPDIR") or "/tmp"
+    return os.path.join(runtime_dir, f"gast-{os.getuid()}-{key}.sock")
+
+
+class Entry:
+    __slots__ = ("key", "code", "tc")
+
+    def __init__(self, key, code):
+        # the stat() results the code was read with
+        self.key = key
+        self.code = code
+        self.tc = None
+
+
+class Index:
+    """
+    The files searched so far, with their code and parsed TreeContext kept in
+    memory. Every search stat()s each file, and re-reads it if its mtime or
+    size changed since it was read. A search that runs to the end forgets
+    the files under its paths that it didn't come across, as they're gone
+    or ignored now.
+    """
+
+    def __init__(self):
+        self.entries = dict()
+
+    def search_file(
+        self,
+        filename,
+        pattern,
+        ignore_case,
+        multiline,
+        encoding,
+        color,
+        line_number,
+        max_count=None,
+        count=False,
+        fixed=False,
+        structured=False,
+        inside=None,
+        outside=None,
+        max_filesize=None,
+        parse_timeout=None,
+        max_lines=None,
+        max_line_length=None,
+    ):
+        """
+        Like search.search_file(), or count_file() with count=True, from memory
+        if the file hasn't changed
+        """
+        path = os.path.abspath(filename)
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.entries.pop(path, None)
+            raise
+
+        # the TreeContext is built with the limits, so other limits need a new one
+        limits = (parse_timeout, max_lines, max_line_length)
+        key = (st.st_mtime_ns, st.st_size, st.st_ino, encoding, max_filesize, limits)
+        entry = self.entries.get(path)
+        if not entry or entry.key != key:
+            code = read_source(filename, encoding, max_size=max_filesize)
+            if code is not None and not is_decodable(code):
+                code = None
+            entry = self.entries[path] = Entry(key, code)
+
+        if entry.code is None:
+            return 0 if count else None
+        if pattern is not None and not may_match(entry.code, pattern, ignore_case, fixed):
+            return 0 if count else None
+
+        tc = entry.tc
+        if tc is None:
+            try:
+                tc = entry.tc = TreeContext(
+                    filename,
+                    entry.code,
+                    parse_timeout=parse_timeout,
+                    max_lines=max_lines,
+                    max_line_length=max_line_length,
+                )
+            except ValueError:
+                entry.code = None
+                return 0 if count else None
+
+        tc.color = color and not count
+        tc.output_lines = dict()
+        try:
+            if pattern is None:
+                loi = tc.query(inside, max_count, outside)
+            else:
+                loi = tc.grep(pattern, ignore_case, multiline, max_count, fixed, inside, outside)
+        except ParseLimitError:
+            # the nodes to filter matches by aren't known without the parse
+            return 0 if count else None
+        if count:
+            return len(loi)
+        if not loi:
+            return
+
+        try:
+            return tc.render(loi, structured, color=color, line_number=line_number)
+        except ParseLimitError:
+            # shown like plain grep, as search_file() does
+            tc.line_number = line_number
+            tc.lines_of_interest = set()
+            tc.add_lines_of_interest(loi)
+            tc.add_grep_context()
+            return tc.result() if structured else tc.format()
+
+    def search(self, request):
+        """
+        Yield (filename, output) for each file matching the search in request,
+        or (filename, count) if its mode isn't "context"
+        """
+        count = request.get("mode", "context") != "context"
+        fnames = enumerate_files(request["filenames"], gitignore=request["gitignore"])
+        results = self.search_files(fnames, request, count)
+        return islice(results, request.get("limit"))
+
+    def search_files(self, fnames, request, count):
+        visited = set()
+        for fname in fnames:
+            visited.add(os.path.abspath(fname))
+            result = self.search_file(
+                fname,
+                request["pattern"],
+                request["ignore_case"],
+                request["multiline"],
+                request["encoding"],
+                request["color"],
+                request["line_number"],
+                request.get("max_count"),
+                count,
+                request.get("fixed", False),
+                request.get("json", False),
+                node_query(request.get("inside")),
+                node_query(request.get("outside")),
+                request.get("max_filesize"),
+                request.get("parse_timeout"),
+                request.get("max_lines"),
+                request.get("max_line_length"),
+            )
+            if result:
+                yield fname, result
+
+        # not reached if the search stops early, at its limit
+        self.prune(request["filenames"], visited)
+
+    def prune(self, paths, visited):
+        """Forget the files under paths, apart from those in visited"""
+        if isinstance(paths, str):
+            paths = [paths]
+        roots = tuple(os.path.abspath(path) for path in paths)
+        prefixes = tuple(os.path.join(root, "") for root in roots)
+
+        for path in list(self.entries):
+            if path in visited:
+                continue
+            if path in roots or path.startswith(prefixes):
+                del self.entries[path]
+
+
+def node_query(value):
+    """A query from a request, where JSON has turned a tuple of node types into a list"""
+    if isinstance(value, list):
+        return tuple(value)
+    return value
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            # requests are handled one at a time, so each can run in its client's directory
+            os.chdir(request["cwd"])
+            mode = request.get("mode", "context")
+            for fname, result in self.server.index.search(request):
+                self.send(out=result_text(fname, result, mode, request.get("json", False)))
+        except BrokenPipeError:
+            pass
+        except Exception as err:
+            traceback.print_exc()
+            self.send(error=f"{type(err).__name__}: {err}")
+
+    def send(self, **message):
+        self.wfile.write(json.dumps(message).encode("utf8") + b"\n")
+
+
+class Server(socketserver.UnixStreamServer):
+    def __init__(self, socket_path):
+        self.index = Index()
+        super().__init__(socket_path, Handler)
+
+
+def serve(socket_path):
+    """Serve searches on socket_path until interrupted"""
+    if os.path.exists(socket_path):
+        if not is_owned(socket_path):
+            print(f"{socket_path} belongs to another user", file=sys.stderr)
+            return 1
+        if is_serving(socket_path):
+            print(f"Already serving on {socket_path}", file=sys.stderr)
+            return 1
+        # left behind by a daemon that didn't exit cleanly
+        os.remove(socket_path)
+
+    with Server(socket_path) as server:
+        os.chmod(socket_path, 0o600)
+        print(f"Serving on {socket_path}", file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(socket_path)
+
+
+def is_owned(socket_path):
+    """
+    True if this user owns socket_path. In a shared directory like /tmp,
+    another user could be listening on it, to see the searches and answer them.
+    """
+    return os.stat(socket_path).st_uid == os.getuid()
+
+
+def is_serving(socket_path):
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(socket_path)
+    except OSError:
+        return False
+    return True
+
+
+def forward(socket_path, request):
+    """
+    Send the search in request to the daemon at socket_path, and return an
+    iterator of ("out", text) or ("error", message) as the answers come back.
+    Raises OSError if there is no daemon, or PermissionError if another user
+    owns the socket.
+    """
+    if not is_owned(socket_path):
+        raise PermissionError(f"{socket_path} belongs to another user")
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(request).encode("utf8") + b"\n")
+    except OSError:
+        sock.close()
+        raise
+    return answers(sock)
+
+
+def answers(sock):
+    with sock, sock.makefile("rb") as stream:
+        for line in stream:
+            message = json.loads(line)
+            for kind, text in message.items():
+                yield kind, text
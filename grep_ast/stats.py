@@ -0,0 +1,98 @@
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager, nullcontext
+
+from .dump import dump  # noqa: F401
+
+# The phases timed, in the order they run for each file
+PHASES = ("enumerate", "read", "cache", "parse", "walk", "grep", "context", "format")
+
+DONE = object()
+
+
+class Stats:
+    """
+    Timings and counters for a search, filled in by passing stats= to
+    TreeContext, search_file() or search_files().
+
+    Every timing goes through add_time(), so a subclass can override it to
+    see each phase as it finishes. Times are summed over files, so with
+    parallel jobs they add up to more than the wall time.
+    """
+
+    def __init__(self):
+        self.times = defaultdict(float)
+
+        # files scanned/skipped/binary/oversized/parsed/degraded/matched,
+        # bytes read, nodes walked
+        self.counts = Counter()
+
+        # per language, the files parsed and the seconds spent in tree-sitter
+        self.parse_files = Counter()
+        self.parse_times = defaultdict(float)
+
+    def add_time(self, phase, seconds, lang=None):
+        self.times[phase] += seconds
+        if phase == "parse" and lang:
+            self.parse_files[lang] += 1
+            self.parse_times[lang] += seconds
+
+    @contextmanager
+    def timer(self, phase, lang=None):
+        """Time the body of a with statement as phase"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.perf_counter() - start, lang)
+
+    def time_iter(self, items, phase):
+        """Yield from items, timing how long each one takes to produce as phase"""
+        items = iter(items)
+        while True:
+            with self.timer(phase):
+                item = next(items, DONE)
+            if item is DONE:
+                return
+            yield item
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+    def merge(self, other):
+        """Add in the stats collected somewhere else, like a worker process"""
+        for phase, seconds in other.times.items():
+            self.times[phase] += seconds
+        for lang, seconds in other.parse_times.items():
+            self.parse_times[lang] += seconds
+        self.counts.update(other.counts)
+        self.parse_files.update(other.parse_files)
+
+    def report(self, wall=None):
+        """A human readable summary, one item per line"""
+        lines = []
+        if wall is not None:
+            lines.append(f"wall time: {wall:.3f}s")
+
+        phases = [phase for phase in PHASES if phase in self.times]
+        phases += sorted(set(self.times) - set(PHASES))
+        for phase in phases:
+            lines.append(f"{phase:>12}: {self.times[phase]:.3f}s")
+
+        for name in ("scanned", "skipped", "binary", "oversized", "parsed", "degraded", "matched"):
+            lines.append(f"files {name}: {self.counts[name]}")
+        lines.append(f"bytes read: {self.counts['bytes']}")
+        lines.append(f"nodes walked: {self.counts['nodes']}")
+
+        for lang in sorted(self.parse_times, key=self.parse_times.get, reverse=True):
+            seconds = self.parse_times[lang]
+            lines.append(f"parse {lang}: {seconds:.3f}s in {self.parse_files[lang]} files")
+
+        return "\n".join(lines)
+
+
+def phase_timer(stats, phase, lang=None):
+    """stats.timer(phase), or a context manager that does nothing if stats is None"""
+    if stats is None:
+        return nullcontext()
+    return stats.timer(phase, lang)
@@ -1,10 +1,176 @@
-try:
-    from tree_sitter_language_pack import get_language, get_parser
+import sys
+import threading
+import time
+from functools import lru_cache
+from importlib import import_module
+from importlib.util import find_spec
 
+# Only check which grammar package is installed here. Importing it is slow,
+# so that waits until the first file actually needs to be parsed.
+if find_spec("tree_sitter_language_pack"):
     USING_TSL_PACK = True
-except ImportError:
-    from tree_sitter_languages import get_language, get_parser
-
+    TSL_PACKAGE = "tree-sitter-language-pack"
+else:
     USING_TSL_PACK = False
+    TSL_PACKAGE = "tree-sitter-languages"
+
+# The bytes handed to tree-sitter at a time when parsing with a deadline
+PARSE_CHUNK = 64 * 1024
+
+# A Parser or Query can't be used by two threads at once, so each thread keeps its own
+_local = threading.local()
+
+# The QueryError messages for queries that are fine, but name node types or
+# fields that a language doesn't have
+FOREIGN_QUERY_ERRORS = ("Invalid node type", "Invalid field name")
+
+
+class InvalidQuery(ValueError):
+    """A tree-sitter query that doesn't compile"""
+
+
+def tsl_module():
+    return import_module(TSL_PACKAGE.replace("-", "_"))
+
+
+@lru_cache(maxsize=None)
+def get_language(lang):
+    return tsl_module().get_language(lang)
+
+
+def get_parser(lang):
+    """The calling thread's parser for lang, created on first use"""
+    parsers = getattr(_local, "parsers", None)
+    if parsers is None:
+        parsers = _local.parsers = dict()
+
+    parser = parsers.get(lang)
+    if parser is None:
+        parser = parsers[lang] = tsl_module().get_parser(lang)
+    return parser
+
+
+def parse_with_timeout(parser, code, timeout=None):
+    """parser.parse(code), or None if it took more than timeout seconds"""
+    if not timeout:
+        return parser.parse(code)
+
+    try:
+        if hasattr(parser, "timeout_micros"):
+            # py-tree-sitter before 0.25
+            parser.timeout_micros = int(timeout * 1_000_000)
+            try:
+                tree = parser.parse(code)
+            finally:
+                parser.timeout_micros = 0
+        else:
+            tree = parse_until(parser, code, time.perf_counter() + timeout)
+    except ValueError:
+        tree = None
+
+    if tree is None:
+        # otherwise the next parse would carry on from where this one stopped
+        parser.reset()
+    return tree
+
+
+def parse_until(parser, code, deadline):
+    """
+    parser.parse(code) for py-tree-sitter 0.25 and later, which dropped
+    timeout_micros, or None if it's still parsing at the perf_counter()
+    deadline. The code is read in chunks, and once the deadline passes the
+    rest reads as empty, which ends the parse.
+    """
+    timed_out = False
+
+    def read(byte, point):
+        nonlocal timed_out
+        if time.perf_counter() > deadline:
+            timed_out = True
+            return b""
+        return code[byte : byte + PARSE_CHUNK]
+
+    options = dict()
+    if sys.version_info >= (3, 14):
+        # this cancels mid-chunk too, but older Pythons crash calling it
+        options["progress_callback"] = lambda offset, has_error: time.perf_counter() > deadline
+
+    tree = parser.parse(read, **options)
+    if timed_out:
+        return
+    return tree
+
+
+def get_query(lang, source):
+    """
+    The calling thread's compiled tree-sitter Query for lang, created on first
+    use. source is an S-expression query, or a tuple of node types to capture.
+    Returns None if the query only uses node types or fields that lang
+    doesn't have, so one query can search files in several languages.
+    Raises InvalidQuery if source isn't a valid query.
+    """
+    queries = getattr(_local, "queries", None)
+    if queries is None:
+        queries = _local.queries = dict()
+
+    key = (lang, source)
+    if key not in queries:
+        queries[key] = compile_query(lang, source)
+    return queries[key]
+
+
+def compile_query(lang, source):
+    from tree_sitter import Query, QueryError
+
+    language = get_language(lang)
+    if isinstance(source, tuple):
+        types = [name for name in source if language.id_for_node_kind(name, True)]
+        if not types:
+            return
+        source = "[" + " ".join(f"({name})" for name in types) + "] @node"
+
+    try:
+        return Query(language, source)
+    except QueryError as err:
+        if str(err).startswith(FOREIGN_QUERY_ERRORS):
+            return
+        raise InvalidQuery(f"Invalid query: {err}")
+
+
+def query_nodes(query, node):
+    """The nodes under node that query captures, whichever py-tree-sitter this is"""
+    if hasattr(query, "captures"):
+        captures = query.captures(node)
+    else:
+        # py-tree-sitter 0.25 and later run queries with a QueryCursor
+        from tree_sitter import QueryCursor
+
+        captures = QueryCursor(query).captures(node)
+
+    if isinstance(captures, dict):
+        return [node for nodes in captures.values() for node in nodes]
+    # py-tree-sitter before 0.23 returns (node, name) pairs
+    return [node for node, name in captures]
+
+
+@lru_cache(maxsize=None)
+def grammar_version():
+    """Parse results depend on the grammars, so anything cached must be keyed by this"""
+    from importlib.metadata import PackageNotFoundError, version
+
+    try:
+        return f"{TSL_PACKAGE}=={version(TSL_PACKAGE)}"
+    except PackageNotFoundError:
+        return f"{TSL_PACKAGE}==unknown"
+
 
-__all__ = [get_parser, get_language, USING_TSL_PACK]
+__all__ = [
+    get_parser,
+    get_language,
+    get_query,
+    query_nodes,
+    parse_with_timeout,
+    InvalidQuery,
+    USING_TSL_PACK,
+    grammar_version,
+]
@@ -0,0 +1,95 @@
+import re
+from collections.abc import Sequence
+from functools import lru_cache
+
+from .dump import dump  # noqa: F401
+
+# str.splitlines() breaks lines on all of these, not just "\n"
+LINE_BREAKS = "\r\v\f\x1c\x1d\x1e\x85\u2028\u2029"
+LINE_BREAK_BYTES = tuple(char.encode("utf8") for char in LINE_BREAKS)
+
+# The only non-ASCII characters that match ASCII letters when ignoring case:
+# dotted and dotless i, long s and the Kelvin sign
+CASE_FOLDS = "\u0130\u0131\u017f\u212a"
+CASE_FOLD_BYTES = tuple(char.encode("utf8") for char in CASE_FOLDS)
+
+# Like grep, a NUL this early in a file means it's binary
+BINARY_CHECK_SIZE = 8192
+
+# Escapes that mean the same on bytes and str, besides escaped punctuation
+SAME_ESCAPES = "ntrfv"
+
+
+def is_binary(data):
+    return b"\0" in data[:BINARY_CHECK_SIZE]
+
+
+def has_odd_line_breaks(text):
+    """True if str.splitlines() would break text (str or UTF-8 bytes) on more than "\\n" """
+    breaks = LINE_BREAK_BYTES if isinstance(text, bytes) else LINE_BREAKS
+    return any(brk in text for brk in breaks)
+
+
+def compile_bytes(pat, flags, data):
+    """
+    Compile pat as a bytes regex, if it matches the same lines of the UTF-8
+    bytes data as pat does in the decoded text. Otherwise return None.
+
+    That holds for ASCII patterns built from literals, positive classes and
+    operators. ".", negated classes, \\w, \\s, \\d, \\b and the like, and inline
+    flags all match differently on bytes, as can ignoring case if data has
+    one of the few non-ASCII characters that fold to ASCII.
+    """
+    regex = bytes_regex(pat, flags)
+    if regex is None:
+        return
+
+    if flags & re.IGNORECASE and any(fold in data for fold in CASE_FOLD_BYTES):
+        return
+    return regex
+
+
+@lru_cache(maxsize=32)
+def bytes_regex(pat, flags):
+    """pat compiled as a bytes regex, or None if it can match differently on bytes"""
+    if not pat.isascii():
+        return
+
+    i = 0
+    while i < len(pat):
+        char = pat[i]
+        next_char = pat[i + 1 : i + 2]
+        if char == "\\":
+            if next_char.isalnum() and next_char not in SAME_ESCAPES:
+                return
+            i += 2
+            continue
+        if char == ".":
+            return
+        if char == "[" and next_char == "^":
+            return
+        if char == "(" and next_char == "?" and pat[i + 2 : i + 3] not in (":", "=", "!", "<", "P"):
+            return
+        i += 1
+
+    return re.compile(pat.encode("ascii"), flags)
+
+
+class Utf8Lines(Sequence):
+    """
+    The lines of UTF-8 bytes that only break lines on "\\n", like
+    str.splitlines() of the decoded text, but decoding each line as it's used.
+    """
+
+    def __init__(self, data):
+        self.raw = data.split(b"\n")
+        if not self.raw[-1]:
+            self.raw.pop()
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [line.decode("utf8", "replace") for line in self.raw[i]]
+        return self.raw[i].decode("utf8", "replace")
@@ -0,0 +1,136 @@
+import os
+from pathlib import Path
+
+from .dump import dump  # noqa: F401
+from .parsers import filename_to_lang
+
+
+def enumerate_files(fnames, gitignore=True):
+    """
+    Yield the source files named by fnames, recursing into directories.
+
+    Hidden files and directories are skipped, and so are files that no parser
+    handles, before they are ever opened. With gitignore=True, anything the
+    .gitignore files of the enclosing repo (including nested ones) or its
+    .git/info/exclude ignore is skipped, and ignored directories aren't entered.
+    Files named in fnames are never ignored.
+    """
+    for fname in fnames:
+        path = Path(fname)
+
+        # oddly, Path('.').name == "" so we will recurse it
+        if path.name.startswith("."):
+            continue
+
+        fname = str(path)
+        if path.is_file():
+            if filename_to_lang(fname):
+                yield fname
+            continue
+
+        if path.is_dir():
+            rules = outer_rules(fname) if gitignore else None
+            yield from walk_dir(fname, os.path.abspath(fname), rules)
+
+
+def walk_dir(dirname, abs_dirname, rules):
+    """
+    Yield the source files under dirname. rules is a list of (directory, spec)
+    for the ignore files that apply, the most specific last, or None.
+    """
+    try:
+        with os.scandir(dirname) as entries:
+            entries = list(entries)
+    except OSError:
+        return
+
+    if rules is not None:
+        spec = read_ignore_file(os.path.join(abs_dirname, ".gitignore"))
+        if spec:
+            rules = rules + [(abs_dirname, spec)]
+
+    for entry in entries:
+        name = entry.name
+        if name.startswith("."):
+            continue
+
+        # like Path.iterdir(), which doesn't prefix "./"
+        path = name if dirname == "." else os.path.join(dirname, name)
+        abs_path = os.path.join(abs_dirname, name)
+
+        if entry.is_file():
+            if filename_to_lang(name) and not is_ignored(rules, abs_path, False):
+                yield path
+        elif entry.is_dir():
+            if not is_ignored(rules, abs_path, True):
+                yield from walk_dir(path, abs_path, rules)
+
+
+def is_ignored(rules, abs_path, is_dir):
+    if not rules:
+        return False
+
+    # the last pattern that matches decides, and deeper ignore files come later
+    for base, spec in reversed(rules):
+        rel_path = abs_path[len(base) :].lstrip(os.sep).replace(os.sep, "/")
+        if is_dir:
+            rel_path += "/"
+        include = spec.check_file(rel_path).include
+        if include is not None:
+            return include
+
+    return False
+
+
+def outer_rules(dirname):
+    """
+    The ignore rules from the directories above dirname: .git/info/exclude and
+    the .gitignore files between the repo root and dirname. Outside a repo,
+    just the nearest .gitignore above dirname.
+    """
+    abs_dirname = os.path.abspath(dirname)
+    parents = [abs_dirname] + [str(parent) for parent in Path(abs_dirname).parents]
+
+    root = None
+    for i, parent in enumerate(parents):
+        if os.path.exists(os.path.join(parent, ".git")):
+            root = i
+            break
+
+    rules = []
+    if root is None:
+        for parent in parents[1:]:
+            spec = read_ignore_file(os.path.join(parent, ".gitignore"))
+            if spec:
+                rules.append((parent, spec))
+                break
+        return rules
+
+    root_dir = parents[root]
+    spec = read_ignore_file(os.path.join(root_dir, ".git", "info", "exclude"))
+    if spec:
+        rules.append((root_dir, spec))
+
+    # dirname's own .gitignore is read when it's walked
+    for parent in reversed(parents[1 : root + 1]):
+        spec = read_ignore_file(os.path.join(parent, ".gitignore"))
+        if spec:
+            rules.append((parent, spec))
+
+    return rules
+
+
+def read_ignore_file(fname):
+    try:
+        with open(fname, encoding="utf8", errors="replace") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return
+
+    if not any(line.strip() and not line.startswith("#") for line in lines):
+        return
+
+    # imported here, as it's slow to import and most directories have no ignore file
+    import pathspec
+
+    return pathspec.GitIgnoreSpec.from_lines(lines)
@@ -0,0 +1,524 @@
+import asyncio
+import io
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import grep_ast.grep_ast
+from grep_ast import ParseLimitError, ScopeCache, Stats, TreeContext
+from grep_ast.dump import dump  # noqa: F401
+from grep_ast.search import (
+    count_file,
+    may_match,
+    search_file,
+    search_files,
+    search_files_async,
+)
+from grep_ast.server import Server, forward
+from grep_ast.tsl import InvalidQuery, get_parser, parse_with_timeout
+from grep_ast.walk import enumerate_files
+
+CODE = """\
+import os
+
+
+class Greeter:
+    def __init__(self, name):
+        self.name = name
+
+    def greet(self):
+        if self.name:
+            print("hello", self.name)
+        return self.name
+"""
+
+
+def test_grep_does_not_parse():
+    tc = TreeContext("example.py", CODE)
+    assert tc.grep("nomatch", False) == set()
+    assert not tc.parsed
+
+    assert tc.grep("hello", False) == {9}
+    assert not tc.parsed
+
+    tc.add_lines_of_interest({9})
+    tc.add_context()
+    assert tc.parsed
+    assert "def greet(self):" in tc.format()
+
+
+def test_enclosing_scopes():
+    tc = TreeContext("example.py", CODE)
+    assert list(tc.enclosing_scopes(9)) == [9, 8, 7, 4, 3, 0]
+    assert list(tc.enclosing_scopes(10)) == [10, 8, 7, 4, 3, 0]
+    assert list(tc.enclosing_scopes(1)) == [0]
+    assert tc.get_last_line_of_scope(7) == 10
+
+
+def test_children_by_size():
+    tc = TreeContext("example.py", CODE)
+    assert list(tc.children_by_size(3)) == [3, 4, 7, 8, 5, 9, 10]
+    assert list(tc.children_by_size(7)) == [7, 8, 9, 10]
+
+
+def test_may_match():
+    assert may_match(CODE, "greet", False)
+    assert may_match(CODE, "GREET", True)
+    assert not may_match(CODE, "GREET", False)
+    assert may_match(CODE, "^class", False)
+    assert not may_match(CODE, "^def", False)
+    assert may_match("x = 1\fdef f(): pass\n", "^def", False)
+
+
+def test_search_files_keeps_order(tmp_path):
+    fnames = []
+    for i in range(40):
+        fname = tmp_path / f"mod{i}.py"
+        fname.write_text(CODE if i % 3 else "x = 1\n")
+        fnames.append(str(fname))
+
+    serial = list(search_files(fnames, "hello"))
+    assert [fname for fname, _ in serial] == [f for i, f in enumerate(fnames) if i % 3]
+
+    parallel = list(search_files(fnames, "hello", jobs=4, threads=True))
+    assert parallel == serial
+
+
+def test_search_files_async(tmp_path):
+    fnames = []
+    for i in range(10):
+        fname = tmp_path / f"mod{i}.py"
+        fname.write_text(CODE if i % 3 else "x = 1\n")
+        fnames.append(str(fname))
+
+    async def collect(limit=None):
+        results = []
+        searches = search_files_async(fnames, "hello", jobs=3)
+        async for result in searches:
+            results.append(result)
+            if len(results) == limit:
+                await searches.aclose()
+                break
+        return results
+
+    assert asyncio.run(collect()) == list(search_files(fnames, "hello"))
+    assert len(asyncio.run(collect(limit=2))) == 2
+
+
+def test_max_count(tmp_path, monkeypatch):
+    fname = tmp_path / "example.py"
+    fname.write_text(CODE)
+    fname = str(fname)
+
+    # counting never parses
+    monkeypatch.setattr(grep_ast.grep_ast, "get_parser", None)
+    assert count_file(fname, "name") == 5
+    assert count_file(fname, "name", max_count=2) == 2
+    assert count_file(fname, "nomatch") == 0
+    assert list(search_files([fname], "self", count=True)) == [(fname, 6)]
+    monkeypatch.undo()
+
+    output = search_file(fname, "name", max_count=1)
+    assert output == render(TreeContext(fname, CODE), "__init__")
+
+
+def test_multiple_patterns():
+    tc = TreeContext("example.py", CODE)
+    assert tc.grep(["hello", "self.name ="], ignore_case=False) == {5, 9}
+    assert tc.line_patterns == {5: ["self.name ="], 9: ["hello"]}
+
+    # literal strings
+    assert tc.grep(["print(", "name)"], ignore_case=False, fixed=True) == {4, 9}
+    assert tc.line_patterns == {4: ["name)"], 9: ["print(", "name)"]}
+    assert may_match(CODE, ["nomatch", "(self"], ignore_case=False, fixed=True)
+    assert not may_match(CODE, ["nomatch", "self("], ignore_case=False, fixed=True)
+
+    tc.add_lines_of_interest({9})
+    tc.add_context()
+    assert '█            print("hello", self.name)  ◀ print(, name)\n' in tc.format()
+
+    # each pattern keeps its own groups, names and flags
+    code = "xx = 1\nyy = 2\nxy = 3\n"
+    tc = TreeContext("br.py", code)
+    assert tc.grep([r"(x)\1", r"(y)\1"], ignore_case=False) == {0, 1}
+    assert may_match(code, [r"(x)\1", r"(y)\1"], ignore_case=False)
+    assert tc.grep([r"(?P<q>x)(?P=q)", r"(?P<q>y)(?P=q)"], ignore_case=False) == {0, 1}
+    assert tc.grep([r"(?i)XY", "yy"], ignore_case=False) == {1, 2}
+
+
+def test_many_patterns_are_combined_once(tmp_path, monkeypatch):
+    fnames = []
+    for i in range(20):
+        fname = tmp_path / f"mod{i}.py"
+        fname.write_text(f"sym{i} = {i}\n")
+        fnames.append(str(fname))
+    patterns = [f"sym{i}" for i in range(200)]
+
+    rewritten = []
+    alternative_source = grep_ast.grep_ast.alternative_source
+
+    def counted(pat, k, offset):
+        rewritten.append(pat)
+        return alternative_source(pat, k, offset)
+
+    grep_ast.grep_ast.pattern_source.cache_clear()
+    monkeypatch.setattr(grep_ast.grep_ast, "alternative_source", counted)
+    assert len(list(search_files(fnames, patterns, fixed=True))) == 20
+    # once for the search, not once per file
+    assert len(rewritten) == len(patterns)
+
+
+def test_parse_limits(tmp_path):
+    fname = tmp_path / "example.py"
+    fname.write_text(CODE)
+    fname = str(fname)
+
+    tc = TreeContext(fname, CODE, max_lines=5)
+    with pytest.raises(ParseLimitError):
+        tc.parse()
+
+    # files over the limits are shown like plain grep would
+    stats = Stats()
+    output = search_file(fname, "hello", max_line_length=20, stats=stats)
+    assert output == '⋮\n█            print("hello", self.name)\n⋮\n'
+    assert stats.counts["degraded"] == 1
+    assert stats.counts["parsed"] == 0
+
+    assert search_file(fname, "hello", max_filesize=100, stats=stats) is None
+    assert stats.counts["oversized"] == 1
+
+
+def test_parse_timeout_without_timeout_micros():
+    class Parser:
+        # like py-tree-sitter 0.25 and later
+        def __init__(self):
+            self.parser = get_parser("python")
+
+        def parse(self, *args, **kwargs):
+            return self.parser.parse(*args, **kwargs)
+
+        def reset(self):
+            self.parser.reset()
+
+    parser = Parser()
+    code = CODE.encode("utf8")
+    tree = parse_with_timeout(parser, code, timeout=5)
+    assert str(tree.root_node) == str(get_parser("python").parse(code).root_node)
+
+    assert parse_with_timeout(parser, code * 1000, timeout=1e-9) is None
+    # and the next parse starts afresh
+    assert not parse_with_timeout(parser, code, timeout=5).root_node.has_error
+
+
+def test_result():
+    tc = TreeContext("example.py", CODE.encode("utf8"))
+    tc.add_lines_of_interest(tc.grep("hello", ignore_case=False))
+    tc.add_context()
+    result = tc.result()
+
+    assert result.lines_of_interest == [9]
+    assert result.shown == [(0, 5), (7, 11)]
+    assert result.gaps == [(5, 7)]
+    assert result.spans == [(9, 19, 24)]
+
+    # the same lines format() shows
+    shown = [line for start, end in result.shown for line in CODE.splitlines()[start:end]]
+    assert [line[1:] for line in tc.format().splitlines() if line != "⋮"] == shown
+
+    # every match, even though color is off and the first of each line was enough for grep()
+    tc = TreeContext("example.py", CODE.encode("utf8"))
+    tc.add_lines_of_interest(tc.grep("name", ignore_case=False))
+    spans = tc.result().spans
+    assert spans[:3] == [(4, 23, 27), (5, 13, 17), (5, 20, 24)]
+
+    # nothing shown, not even a gap, as format() returns ""
+    result = TreeContext("example.py", CODE).result()
+    assert result.shown == result.gaps == []
+
+
+def test_query():
+    code = CODE + '# the name in a comment\nx = "name"\n'
+    tc = TreeContext("example.py", code)
+    assert tc.grep("name", ignore_case=False) == {4, 5, 8, 9, 10, 11, 12}
+
+    assert tc.grep("name", ignore_case=False, outside=("comment", "string")) == {4, 5, 8, 9, 10}
+    assert tc.grep("name", ignore_case=False, inside="(call) @call") == {9}
+    # node types a language doesn't have match nothing
+    assert tc.grep("name", ignore_case=False, inside=("no_such_node",)) == set()
+
+    assert tc.query("(function_definition name: (identifier) @name)") == {4, 7}
+    assert tc.query(("class_definition",)) == {3}
+    assert tc.query("(string) @s", outside=("call",)) == {12}
+    with pytest.raises(InvalidQuery):
+        tc.query("(((")
+
+
+def test_parsers_are_reused_per_thread():
+    parser = get_parser("python")
+    assert get_parser("python") is parser
+
+    with ThreadPoolExecutor(1) as executor:
+        other = executor.submit(get_parser, "python").result()
+    assert other is not parser
+
+
+def render(tc, pat):
+    tc.add_lines_of_interest(tc.grep(pat, False))
+    tc.add_context()
+    return tc.format()
+
+
+def test_scope_cache(tmp_path, monkeypatch):
+    fname = tmp_path / "example.py"
+    fname.write_text(CODE)
+    cache = ScopeCache(str(tmp_path / "cache"))
+
+    expected = render(TreeContext(str(fname), CODE), "hello")
+    assert render(TreeContext(str(fname), CODE, cache=cache), "hello") == expected
+
+    def no_parsing(lang):
+        raise AssertionError("parsed a cached file")
+
+    monkeypatch.setattr(grep_ast.grep_ast, "get_parser", no_parsing)
+    assert render(TreeContext(str(fname), CODE, cache=cache), "hello") == expected
+
+    # a changed file misses the cache
+    fname.write_text(CODE + "x = 1\n")
+    with pytest.raises(AssertionError):
+        TreeContext(str(fname), CODE + "x = 1\n", cache=cache).parse()
+
+
+def test_update_matches_fresh_parse():
+    tc = TreeContext("example.py", CODE, incremental=True)
+    tc.parse()
+
+    edits = [
+        CODE.replace("    def greet", "    def shout(self):\n        return 1\n\n    def greet"),
+        CODE.replace("import os\n", ""),
+        CODE.replace("hello", "goodbye"),
+    ]
+    for code in edits:
+        tc.update(code)
+        fresh = TreeContext("example.py", code)
+        for name in TreeContext.TABLES:
+            assert getattr(tc, name) == getattr(fresh, name), name
+        assert render(tc, "self.name") == render(fresh, "self.name")
+
+    # UTF-8 bytes, like __init__ takes
+    tc = TreeContext("example.py", CODE.encode("utf8"), incremental=True)
+    tc.parse()
+    for code in edits:
+        tc.update(code.encode("utf8"))
+        fresh = TreeContext("example.py", code)
+        assert tc.code == code
+        assert render(tc, "self.name") == render(fresh, "self.name")
+
+
+def test_deep_nesting():
+    # deeper than the default recursion limit
+    code = "[\n" * 1200 + "1\n" + "]\n" * 1200
+    tc = TreeContext("deep.json", code)
+    tc.add_lines_of_interest({1200})
+    tc.add_context()
+    assert len(list(tc.enclosing_scopes(1200))) == 1201
+    assert "█1" in tc.format()
+
+
+def test_grep_matches_line_by_line():
+    tc = TreeContext("example.py", CODE, color=True)
+    assert tc.grep(r"self\s*", False) == {4, 5, 7, 8, 9, 10}
+    assert tc.output_lines[5] == "        \033[1;31mself\033[0m.name = name"
+
+    # a match can't run into the next line unless multiline is on
+    assert tc.grep(r"name\s+def", False) == set()
+    assert tc.grep(r"name\s+def", False, multiline=True) == {5, 6, 7}
+    assert tc.grep(r"^$", False) == {1, 2, 6}
+
+
+def test_write_to():
+    tc = TreeContext("example.py", CODE, line_number=True)
+    tc.add_lines_of_interest({9})
+    tc.add_context()
+
+    output = tc.format()
+    assert output.startswith("  1│import os\n")
+    assert "...⋮...\n" in output
+
+    text = io.StringIO()
+    tc.write_to(text)
+    assert text.getvalue() == output
+
+    binary = io.BytesIO()
+    tc.write_to(binary)
+    assert binary.getvalue() == output.encode("utf8")
+
+
+def test_enumerate_files(tmp_path, monkeypatch):
+    files = {
+        ".gitignore": "build/\n*.gen.py\n",
+        ".git/info/exclude": "scratch.py\n",
+        "a.py": "",
+        "notes.txt": "",
+        "scratch.py": "",
+        "x.gen.py": "",
+        "build/b.py": "",
+        "sub/.gitignore": "*.js\n!keep.js\n",
+        "sub/c.py": "",
+        "sub/d.js": "",
+        "sub/keep.js": "",
+        "sub/.hidden.py": "",
+    }
+    for fname, content in files.items():
+        path = tmp_path / fname
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+
+    monkeypatch.chdir(tmp_path)
+    assert sorted(enumerate_files(["."])) == ["a.py", "sub/c.py", "sub/keep.js"]
+    assert sorted(enumerate_files(["sub"])) == ["sub/c.py", "sub/keep.js"]
+    assert "build/b.py" in list(enumerate_files(["."], gitignore=False))
+
+    # files named explicitly are searched even if ignored
+    assert list(enumerate_files(["scratch.py", "notes.txt"])) == ["scratch.py"]
+
+
+def test_render():
+    tc = TreeContext("example.py", CODE)
+    tc.add_lines_of_interest({5})
+    tc.add_context()
+    before = tc.format()
+
+    expected = [render(TreeContext("example.py", CODE), pat) for pat in ("hello", "import")]
+    assert tc.render({9}) == expected[0]
+    assert tc.render_many([{9}, {0}]) == expected
+
+    numbered = TreeContext("example.py", CODE, line_number=True)
+    assert tc.render({9}, line_number=True) == render(numbered, "hello")
+
+    # turning color off drops the grep highlights too
+    colored = TreeContext("example.py", CODE, color=True)
+    colored.grep("hello", ignore_case=False)
+    assert "\033[" in colored.render({9})
+    assert colored.render({9}, color=False) == expected[0]
+
+    # rendering leaves the context's own lines alone
+    assert tc.lines_of_interest == {5}
+    assert tc.format() == before
+
+    with pytest.raises(TypeError):
+        tc.render({9}, header_max=3)
+
+
+def test_stats(tmp_path):
+    fnames = []
+    for i, code in enumerate([CODE, "x = 1\n", "hello = '\udcff'\n"]):
+        fname = tmp_path / f"mod{i}.py"
+        fname.write_text(code, errors="surrogateescape")
+        fnames.append(str(fname))
+
+    stats = Stats()
+    assert len(list(search_files(fnames, "hello", stats=stats))) == 1
+    assert stats.counts["scanned"] == 3
+    assert stats.counts["skipped"] == 1
+    assert stats.counts["parsed"] == stats.counts["matched"] == 1
+    # single-line nodes aren't walked into
+    tree = get_parser("python").parse(CODE.encode("utf8"))
+    assert 0 < stats.counts["nodes"] < tree.root_node.descendant_count
+    assert stats.parse_files == {"python": 1}
+    assert {"read", "parse", "walk", "grep", "context", "format"} <= set(stats.times)
+    assert "files matched: 1" in stats.report()
+
+    class Phases(Stats):
+        def add_time(self, phase, seconds, lang=None):
+            super().add_time(phase, seconds, lang)
+            phases.append(phase)
+
+    phases = []
+    render(TreeContext("example.py", CODE, stats=Phases()), "hello")
+    assert phases == ["grep", "parse", "walk", "context", "format"]
+
+
+def test_bytes_code(tmp_path):
+    code = CODE.replace("hello", "héllo") + "# K\n"
+    data = code.encode("utf8")
+    for pat, ignore_case in [("llo", False), ("k", True), (r"\w+llo", False), ("^$", False)]:
+        text = TreeContext("example.py", code, color=True)
+        raw = TreeContext("example.py", data, color=True)
+        assert raw.grep(pat, ignore_case) == text.grep(pat, ignore_case), pat
+        assert raw.output_lines == text.output_lines
+    assert render(raw, "self") == render(text, "self")
+    assert raw.code == code
+
+    # a form feed breaks lines for str.splitlines() but not for tree-sitter
+    odd = TreeContext("example.py", data.replace(b"\n\n\n", b"\n\f\n"))
+    assert odd.lines == code.replace("\n\n\n", "\n\f\n").splitlines()
+
+    binary = tmp_path / "binary.py"
+    binary.write_bytes(b"hello = '\0'\n")
+    assert list(search_files([str(binary)], "hello")) == []
+
+
+def test_server(tmp_path, monkeypatch):
+    fname = tmp_path / "example.py"
+    fname.write_text(CODE)
+    monkeypatch.chdir(tmp_path)
+
+    socket_path = str(tmp_path / "gast.sock")
+    server = Server(socket_path)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+
+    def search(pattern, **options):
+        request = dict(
+            cwd=str(tmp_path),
+            pattern=pattern,
+            filenames=["."],
+            gitignore=True,
+            ignore_case=False,
+            multiline=False,
+            encoding="utf8",
+            color=False,
+            line_number=False,
+            **options,
+        )
+        return list(forward(socket_path, request))
+
+    try:
+        expected = render(TreeContext("example.py", CODE), "hello")
+        assert search("hello") == [("out", f"\nexample.py:\n{expected}\n")]
+        assert search("nomatch") == []
+        assert search("(")[0][0] == "error"
+        assert search("self", mode="count", max_count=2) == [("out", "example.py:2\n")]
+        [(kind, text)] = search("hello", json=True)
+        assert json.loads(text)["lines_of_interest"] == [9]
+
+        # the same parse limits as a local search
+        degraded = search_file("example.py", "hello", max_line_length=20)
+        assert search("hello", max_line_length=20) == [("out", f"\nexample.py:\n{degraded}\n")]
+        assert search("hello") == [("out", f"\nexample.py:\n{expected}\n")]
+        assert search("hello", max_filesize=100) == []
+
+        # a changed file is read again
+        fname.write_text(CODE.replace("hello", "goodbye") + "# longer now\n")
+        assert search("hello") == []
+        assert len(search("goodbye")) == 1
+
+        # files that aren't there anymore are forgotten
+        other = tmp_path / "other.py"
+        other.write_text(CODE)
+        assert len(search("self")) == 2
+        other.unlink()
+        assert len(search("self")) == 1
+        assert list(server.index.entries) == [str(fname)]
+
+        # a socket someone else owns could be anyone's daemon
+        monkeypatch.setattr(os, "getuid", lambda: os.stat(socket_path).st_uid + 1)
+        with pytest.raises(PermissionError):
+            search("goodbye")
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()